@@ -0,0 +1,288 @@
+# coding=utf-8
+"""
+Replays a recorded gcode file and a temperature log through the plugin's comm hooks (processGCODE,
+processAtCommand and monitor_temperatures) against a stub printer and stub settings, and reports the
+overhead per hook call: wall time, memory allocated and threads started.
+
+The hooks run on OctoPrint's comm thread, so this is meant to keep their cost on a budget:
+
+    python extras/replay_hooks.py --gcode print.gcode --temps serial.log --budget-us 50
+
+Needs OctoPrint and the plugin installed in the current environment. No plug is contacted, device
+requests fail immediately as if the plug was unreachable. Settings can be overridden with a JSON file,
+e.g. {"powerOffWhenIdle": true, "thermal_runaway_monitoring": true}.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+GCODE_REGEX = re.compile(r"^\s*([GMT]\d+(\.\d+)?)", re.IGNORECASE)
+TEMPERATURE_REGEX = re.compile(r"(B|C|T\d*):\s*(-?\d+\.?\d*)(\s*/\s*(-?\d+\.?\d*))?")
+HEATER_NAMES = dict(T="tool", B="bed", C="chamber")
+
+
+class StubSettings(object):
+
+	def __init__(self, values):
+		self._values = values
+
+	def get(self, path, *args, **kwargs):
+		return self._values.get(path[0])
+
+	def get_int(self, path, *args, **kwargs):
+		value = self.get(path)
+		return int(value) if value is not None else None
+
+	def get_boolean(self, path, *args, **kwargs):
+		return bool(self.get(path))
+
+	getBoolean = get_boolean
+
+	def set(self, path, value, *args, **kwargs):
+		self._values[path[0]] = value
+
+	set_boolean = set
+
+	def save(self, *args, **kwargs):
+		pass
+
+
+class StubPrinter(object):
+
+	def __init__(self):
+		self.temperatures = {}
+
+	def is_printing(self):
+		return True
+
+	def is_paused(self):
+		return False
+
+	def is_ready(self):
+		return False
+
+	def is_closed_or_error(self):
+		return False
+
+	def get_current_temperatures(self):
+		return dict((heater, dict(actual=actual, target=target))
+					for heater, (actual, target) in self.temperatures.items())
+
+	def set_temperature(self, heater, value):
+		pass
+
+	def connect(self, *args, **kwargs):
+		pass
+
+	def disconnect(self, *args, **kwargs):
+		pass
+
+
+class StubPluginManager(object):
+
+	def send_plugin_message(self, identifier, data):
+		pass
+
+
+def offline_login(plug):
+	raise IOError("No devices are contacted during a replay")
+
+
+def load_plugin(overrides):
+	import logging
+
+	import octoprint_taposmartplug
+	from octoprint_taposmartplug.sessions import SessionPool
+
+	plugin = octoprint_taposmartplug.taposmartplugPlugin()
+	settings = plugin.get_settings_defaults()
+	settings.update(overrides)
+	plugin._settings = StubSettings(settings)
+	plugin._printer = StubPrinter()
+	plugin._plugin_manager = StubPluginManager()
+	plugin._identifier = "taposmartplug"
+	plugin._taposmartplug_logger.setLevel(logging.DEBUG if settings.get("debug_logging") else logging.INFO)
+	plugin._taposmartplug_logger.addHandler(logging.NullHandler())
+	plugin._taposmartplug_logger.propagate = False
+	plugin._plug_request = lambda plug, action: None
+	plugin._sessions = SessionPool(plugin._taposmartplug_logger, factory=offline_login)
+
+	# the settings on_after_startup would read, without polling, backfills or the startup power on
+	plugin.powerOffWhenIdle = plugin._settings.get_boolean(["powerOffWhenIdle"])
+	plugin.abortTimeout = plugin._settings.get_int(["abortTimeout"])
+	plugin.idleTimeout = plugin._settings.get_int(["idleTimeout"])
+	plugin.idleIgnoreCommands = plugin._settings.get(["idleIgnoreCommands"])
+	plugin._idleIgnoreCommandsArray = plugin.idleIgnoreCommands.split(',')
+	plugin.idleTimeoutWaitTemp = plugin._settings.get_int(["idleTimeoutWaitTemp"])
+	plugin._idle.idle_timeout = plugin.idleTimeout * 60
+	plugin._idle.countdown = plugin.abortTimeout
+	plugin._thermal = plugin._build_thermal_monitor()
+	if plugin.powerOffWhenIdle:
+		plugin._idle.enable("replay")
+	return plugin
+
+
+def read_gcode(path):
+	"""Yields ("gcode", (cmd, gcode)) and ("atcommand", (command, parameters)) in file order."""
+	with open(path) as f:
+		for line in f:
+			cmd = line.split(";", 1)[0].strip()
+			if not cmd:
+				continue
+			if cmd.startswith("@"):
+				parts = cmd[1:].split(None, 1)
+				yield "atcommand", (parts[0], parts[1] if len(parts) > 1 else "")
+				continue
+			match = GCODE_REGEX.match(cmd)
+			yield "gcode", (cmd, match.group(1).upper() if match else None)
+
+
+def read_temperatures(path):
+	"""Yields parsed_temps dicts like OctoPrint hands to the temperatures hook, one per report line."""
+	with open(path) as f:
+		for line in f:
+			if "T:" not in line and "B:" not in line:
+				continue
+			parsed = {}
+			for heater, actual, _, target in TEMPERATURE_REGEX.findall(line):
+				if heater == "T":
+					heater = "T0"
+				parsed[heater] = (float(actual), float(target) if target else None)
+			if parsed:
+				yield parsed
+
+
+class ThreadCounter(object):
+	"""Counts Thread.start() calls, Timers included, while active."""
+
+	def __init__(self):
+		self.count = 0
+		self._original = threading.Thread.start
+
+	def __enter__(self):
+		counter = self
+
+		def start(thread):
+			counter.count += 1
+			return counter._original(thread)
+
+		threading.Thread.start = start
+		return self
+
+	def __exit__(self, *args):
+		threading.Thread.start = self._original
+
+
+class HookStats(object):
+
+	def __init__(self, name):
+		self.name = name
+		self.durations = []
+		self.allocated = []
+		self.threads = 0
+
+	def report(self):
+		if not self.durations:
+			return "%-22s no calls" % self.name
+		durations = sorted(self.durations)
+		count = len(durations)
+		allocated = self.allocated or [0]
+		return "%-22s %8d calls  mean %8.1fus  p50 %8.1fus  p99 %8.1fus  max %9.1fus  alloc mean %7.0fB max %8dB  threads %d" % (
+			self.name, count, sum(durations) / count * 1e6, durations[count // 2] * 1e6,
+			durations[min(count - 1, int(count * 0.99))] * 1e6, durations[-1] * 1e6,
+			sum(allocated) / float(len(allocated)), max(allocated), self.threads)
+
+	def p99(self):
+		durations = sorted(self.durations)
+		return durations[min(len(durations) - 1, int(len(durations) * 0.99))] if durations else 0
+
+
+def replay(plugin, calls, measure_allocations):
+	stats = dict(gcode=HookStats("processGCODE"), atcommand=HookStats("processAtCommand"),
+				 temperatures=HookStats("monitor_temperatures"))
+	hooks = dict(gcode=lambda args: plugin.processGCODE(None, "queuing", args[0], None, args[1]),
+				 atcommand=lambda args: plugin.processAtCommand(None, "sending", args[0], args[1]),
+				 temperatures=lambda args: plugin.monitor_temperatures(None, args))
+
+	for kind, args in calls:
+		if kind == "temperatures":
+			plugin._printer.temperatures = dict((HEATER_NAMES.get(heater[0], "tool") + heater[1:], value)
+												for heater, value in args.items())
+		hook = hooks[kind]
+		with ThreadCounter() as threads:
+			if measure_allocations:
+				before = tracemalloc.get_traced_memory()[0]
+				tracemalloc.reset_peak()
+				hook(args)
+				stats[kind].allocated.append(max(0, tracemalloc.get_traced_memory()[1] - before))
+			else:
+				started = time.perf_counter()
+				hook(args)
+				stats[kind].durations.append(time.perf_counter() - started)
+		if not measure_allocations:
+			stats[kind].threads += threads.count
+	return stats
+
+
+def interleave(gcode, temperatures, ratio):
+	"""Mixes temperature reports into the gcode stream, one report every ratio commands."""
+	gcode = list(gcode)
+	temperatures = list(temperatures)
+	calls = []
+	for index, call in enumerate(gcode):
+		calls.append(call)
+		if temperatures and index % ratio == 0:
+			calls.append(("temperatures", temperatures[(index // ratio) % len(temperatures)]))
+	if not gcode:
+		calls = [("temperatures", temps) for temps in temperatures]
+	return calls
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Measures the overhead of the TapoSmartplug comm hooks.")
+	parser.add_argument("--gcode", help="gcode file to feed through the gcode and @command hooks")
+	parser.add_argument("--temps", help="serial log or M105 responses to feed through the temperature hook")
+	parser.add_argument("--settings", help="JSON file with plugin settings overriding the defaults")
+	parser.add_argument("--temps-every", type=int, default=50, help="gcode lines per temperature report")
+	parser.add_argument("--budget-us", type=float, help="fail if the p99 of any hook exceeds this many microseconds")
+	args = parser.parse_args(argv)
+
+	if not args.gcode and not args.temps:
+		parser.error("nothing to replay, pass --gcode and/or --temps")
+
+	overrides = {}
+	if args.settings:
+		with open(args.settings) as f:
+			overrides = json.load(f)
+
+	calls = interleave(read_gcode(args.gcode) if args.gcode else [],
+					   read_temperatures(args.temps) if args.temps else [], max(args.temps_every, 1))
+
+	plugin = load_plugin(overrides)
+	timings = replay(plugin, calls, False)
+	tracemalloc.start()
+	allocations = replay(load_plugin(overrides), calls, True)
+	tracemalloc.stop()
+
+	print("Replayed %s hook calls." % len(calls))
+	over_budget = []
+	for kind, stats in timings.items():
+		stats.allocated = allocations[kind].allocated
+		print(stats.report())
+		if args.budget_us is not None and stats.p99() * 1e6 > args.budget_us:
+			over_budget.append(stats.name)
+
+	if over_budget:
+		print("Over the %sus budget: %s" % (args.budget_us, ", ".join(over_budget)))
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
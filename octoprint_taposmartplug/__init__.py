@@ -1,78 +1,38 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import time
+
+_import_started = time.time()
+
 import octoprint.plugin
 from octoprint.access.permissions import Permissions, ADMIN_GROUP, USER_GROUP
 from octoprint.events import eventManager, Events
 from octoprint.util import RepeatedTimer
 from flask_babel import gettext
-import socket
 import json
 import flask
 import logging
 import os
-import re
 import threading
-import time
-import sqlite3
-import decimal
-from uptime import uptime
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from struct import unpack
 from builtins import bytes
-from PyP100 import PyP100
-
-try:
-	from octoprint.util import ResettableTimer
-except:
-	class ResettableTimer(threading.Thread):
-		def __init__(self, interval, function, args=None, kwargs=None, on_reset=None, on_cancelled=None):
-			threading.Thread.__init__(self)
-			self._event = threading.Event()
-			self._mutex = threading.Lock()
-			self.is_reset = True
-
-			if args is None:
-				args = []
-			if kwargs is None:
-				kwargs = dict()
-
-			self.interval = interval
-			self.function = function
-			self.args = args
-			self.kwargs = kwargs
-			self.on_cancelled = on_cancelled
-			self.on_reset = on_reset
-
-		def run(self):
-			while self.is_reset:
-				with self._mutex:
-					self.is_reset = False
-				self._event.wait(self.interval)
-
-			if not self._event.isSet():
-				self.function(*self.args, **self.kwargs)
-			with self._mutex:
-				self._event.set()
-
-		def cancel(self):
-			with self._mutex:
-				self._event.set()
-
-			if callable(self.on_cancelled):
-				self.on_cancelled()
-
-		def reset(self, interval=None):
-			with self._mutex:
-				if interval:
-					self.interval = interval
-
-				self.is_reset = True
-				self._event.set()
-				self._event.clear()
-
-			if callable(self.on_reset):
-				self.on_reset()
+from .breaker import CircuitBreaker
+from .idle import IdleStateMachine, COUNTDOWN
+from .ring import PowerRings
+from .logutil import PlugSummary, RepeatedMessageFilter, start_queued_logging
+from .sessions import (SessionPool, get_child_device_list, get_device_info, has_energy_monitoring, outlet_index,
+					   outlet_info, plug_host, set_device_on, tapo_request)
+from .storage import EnergyStore
+from .thermal import ThermalMonitor
+from .profiler import SamplingProfiler
+from .tariff import Tariff, CostCache, TIMESTAMP_FORMAT, aggregate_costs, day_segments, normalize_timestamp
+
+# PyP100 (and its crypto stack), sqlite3, uptime, socket, re and the broker client are imported where
+# they are used, they are not needed to load the plugin.
+
 
 
 class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
@@ -80,6 +40,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 							octoprint.plugin.TemplatePlugin,
 							octoprint.plugin.SimpleApiPlugin,
 							octoprint.plugin.StartupPlugin,
+							octoprint.plugin.ShutdownPlugin,
 							octoprint.plugin.ProgressPlugin,
 							octoprint.plugin.EventHandlerPlugin):
 
@@ -87,22 +48,47 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		self._logger = logging.getLogger("octoprint.plugins.taposmartplug")
 		self._taposmartplug_logger = logging.getLogger("octoprint.plugins.taposmartplug.debug")
 		self.abortTimeout = 0
-		self._timeout_value = None
-		self._abort_timer = None
 		self._countdown_active = False
 		self.print_job_started = False
-		self._waitForHeaters = False
-		self._waitForTimelapse = False
 		self._timelapse_active = False
-		self._skipIdleTimer = False
 		self.powerOffWhenIdle = False
-		self._idleTimer = None
+		self._idle = IdleStateMachine(self._taposmartplug_logger, 0, 0, self._idle_may_power_off,
+									  self._turn_off_heaters, self._heaters_cooled, lambda: self._timelapse_active,
+									  self._shutdown_system, on_transition=self._idle_transition)
 		self._autostart_file = None
 		self.db_path = None
+		self._logging_listener = None
+		self._broker = None
+		self.poll_status = None
+		self._poll_generation = 0
+		self._poll_mutex = threading.Lock()
+		self._energy_store = None
+		self._profiler = None
+		self._power_rings = PowerRings()
+		self._thermal = None
+		self._thermal_shutdown_mutex = threading.Lock()
+		self._load_times = dict(import_ms=_import_duration_ms())
+		self._tariffs = {}
+		self._plug_states = {}
+		self._state_version = 0
+		self._state_epoch = uuid.uuid4().hex[:8]
+		self._plug_states_mutex = threading.Lock()
+		self._cost_cache = CostCache()
+		self._print_started_at = None
+		self._backfills_running = set()
+		self._backfills_mutex = threading.Lock()
+		self._breakers = {}
+		self._breakers_mutex = threading.Lock()
+		self._sessions = None
+		self._jobs = {}
+		self._jobs_mutex = threading.Lock()
+		self._startup_power_on_started = False
+		self._startup_power_on_mutex = threading.Lock()
 
 	##~~ StartupPlugin mixin
 
 	def on_startup(self, host, port):
+		startup_started = time.time()
 		# setup customized logger
 		from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
 		taposmartplug_logging_handler = CleaningTimedRotatingFileHandler(
@@ -110,50 +96,66 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		taposmartplug_logging_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
 		taposmartplug_logging_handler.setLevel(logging.DEBUG)
 
-		self._taposmartplug_logger.addHandler(taposmartplug_logging_handler)
+		# file writes happen on the listener thread, not in the comm, timer or request threads that log
+		self._logging_listener = start_queued_logging(self._taposmartplug_logger, taposmartplug_logging_handler)
+		self._taposmartplug_logger.addFilter(RepeatedMessageFilter())
 		self._taposmartplug_logger.setLevel(
 			logging.DEBUG if self._settings.get_boolean(["debug_logging"]) else logging.INFO)
 		self._taposmartplug_logger.propagate = False
 
 		self.db_path = os.path.join(self.get_plugin_data_folder(), "energy_data.db")
-		if not os.path.exists(self.db_path):
-			db = sqlite3.connect(self.db_path)
-			cursor = db.cursor()
-			cursor.execute(
-				'''CREATE TABLE energy_data(id INTEGER PRIMARY KEY, ip TEXT, timestamp TEXT, current REAL, power REAL, total REAL, voltage REAL)''')
-			db.commit()
-			db.close()
+		self._sessions = SessionPool(self._taposmartplug_logger, self._settings.get_int(["session_ttl"]))
+		self._power_rings.resize(self._settings.get_int(["live_buffer_size"]))
+		self._start_broker_client()
+
+		self._energy_store = EnergyStore(self.db_path, self._taposmartplug_logger)
+		self._energy_store.initialize_async()
+		self._profiler = SamplingProfiler(self._taposmartplug_logger,
+										  os.path.join(self.get_plugin_data_folder(), "profiles"))
+
+		self._load_times["on_startup_ms"] = round((time.time() - startup_started) * 1000, 1)
+		self._logger.info("TapoSmartplug import took %sms, on_startup took %sms.",
+						  self._load_times["import_ms"], self._load_times["on_startup_ms"])
 
 	def on_after_startup(self):
 		self._logger.info("TapoSmartplug loaded!")
-		if self._settings.get(["pollingEnabled"]):
-			self.poll_status = RepeatedTimer(int(self._settings.get(["pollingInterval"])) * 60, self.check_statuses)
-			self.poll_status.start()
+		self._start_polling()
 
 		self.abortTimeout = self._settings.get_int(["abortTimeout"])
-		self._taposmartplug_logger.debug("abortTimeout: %s" % self.abortTimeout)
+		self._taposmartplug_logger.debug("abortTimeout: %s", self.abortTimeout)
 
 		self.powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
-		self._taposmartplug_logger.debug("powerOffWhenIdle: %s" % self.powerOffWhenIdle)
+		self._taposmartplug_logger.debug("powerOffWhenIdle: %s", self.powerOffWhenIdle)
 
 		self.idleTimeout = self._settings.get_int(["idleTimeout"])
-		self._taposmartplug_logger.debug("idleTimeout: %s" % self.idleTimeout)
+		self._taposmartplug_logger.debug("idleTimeout: %s", self.idleTimeout)
 		self.idleIgnoreCommands = self._settings.get(["idleIgnoreCommands"])
 		self._idleIgnoreCommandsArray = self.idleIgnoreCommands.split(',')
-		self._taposmartplug_logger.debug("idleIgnoreCommands: %s" % self.idleIgnoreCommands)
+		self._taposmartplug_logger.debug("idleIgnoreCommands: %s", self.idleIgnoreCommands)
 		self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
-		self._taposmartplug_logger.debug("idleTimeoutWaitTemp: %s" % self.idleTimeoutWaitTemp)
+		self._taposmartplug_logger.debug("idleTimeoutWaitTemp: %s", self.idleTimeoutWaitTemp)
 		if self._settings.get_boolean(["event_on_startup_monitoring"]) is True:
-			self._taposmartplug_logger.debug("powering on due to startup.")
-			for plug in self._settings.get(['arrSmartplugs']):
-				if plug["event_on_startup"] is True:
-					self._taposmartplug_logger.debug("powering on %s due to startup." % (plug["ip"]))
-					response = self.turn_on(plug["ip"])
-					if response.get("currentState", False) == "on":
-						self._plugin_manager.send_plugin_message(self._identifier, response)
-					else:
-						self._taposmartplug_logger.debug("powering on %s during startup failed." % (plug["ip"]))
-		self._reset_idle_timer()
+			self._startup_power_on("startup")
+		self._start_energy_backfill()
+		self._thermal = self._build_thermal_monitor()
+
+		self._idle.idle_timeout = self.idleTimeout * 60
+		self._idle.countdown = self.abortTimeout
+		self._idle.start()
+		if self.powerOffWhenIdle:
+			self._idle.enable("startup")
+
+	##~~ ShutdownPlugin mixin
+
+	def on_shutdown(self):
+		self._idle.stop()
+		if self._profiler is not None:
+			self._profiler.stop()
+		if self._broker is not None:
+			self._broker.close()
+		if self._logging_listener is not None:
+			self._logging_listener.stop()
+			self._logging_listener = None
 
 	##~~ SettingsPlugin mixin
 
@@ -171,24 +173,39 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			event_on_upload_monitoring=False,
 			event_on_startup_monitoring=False,
 			cost_rate=0,
+			energy_backfill_days=2,
+			tariff_bands=[],
 			abortTimeout=30,
 			powerOffWhenIdle=False,
 			idleTimeout=30,
 			idleIgnoreCommands='M105',
 			idleTimeoutWaitTemp=50,
-			progress_polling=False
+			progress_polling=False,
+			breaker_failure_threshold=2,
+			breaker_reset_timeout=60,
+			session_ttl=300,
+			live_buffer_size=360,
+			broker_enabled=False,
+			broker_socket="",
+			thermal_runaway_prewarm_margin=10,
+			thermal_runaway_window=30,
+			thermal_runaway_max_rise=0,
+			thermal_runaway_max_deviation=0
 		)
 
 	def on_settings_save(self, data):
 		old_debug_logging = self._settings.get_boolean(["debug_logging"])
 		old_polling_value = self._settings.get_boolean(["pollingEnabled"])
 		old_polling_timer = self._settings.get(["pollingInterval"])
+		old_broker = (self._settings.get_boolean(["broker_enabled"]), self._settings.get(["broker_socket"]))
 		old_powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
 		old_idleTimeout = self._settings.get_int(["idleTimeout"])
 		old_idleIgnoreCommands = self._settings.get(["idleIgnoreCommands"])
 		old_idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
 
 		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+		with self._plug_states_mutex:
+			self._state_version += 1
 
 		self.abortTimeout = self._settings.get_int(["abortTimeout"])
 		self.powerOffWhenIdle = self._settings.get_boolean(["powerOffWhenIdle"])
@@ -198,18 +215,30 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		self._idleIgnoreCommandsArray = self.idleIgnoreCommands.split(',')
 		self.idleTimeoutWaitTemp = self._settings.get_int(["idleTimeoutWaitTemp"])
 
-		if self.powerOffWhenIdle != old_powerOffWhenIdle:
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
+		self._idle.idle_timeout = self.idleTimeout * 60
+		self._idle.countdown = self.abortTimeout
 
-		if self.powerOffWhenIdle == True:
-			self._taposmartplug_logger.debug("Settings saved, Automatic Power Off Enabled, starting idle timer...")
-			self._reset_idle_timer()
+		if self.powerOffWhenIdle != old_powerOffWhenIdle:
+			if self.powerOffWhenIdle:
+				self._idle.enable("settings saved")
+			else:
+				self._idle.disable("settings saved")
+			self._send_idle_state()
+		elif self.powerOffWhenIdle == True:
+			self._taposmartplug_logger.debug("Settings saved, Automatic Power Off Enabled, restarting idle timeout...")
+			self._idle.activity("settings saved", abort=False)
 
 		new_debug_logging = self._settings.get_boolean(["debug_logging"])
 		new_polling_value = self._settings.get_boolean(["pollingEnabled"])
 		new_polling_timer = self._settings.get(["pollingInterval"])
+		new_broker = (self._settings.get_boolean(["broker_enabled"]), self._settings.get(["broker_socket"]))
+
+		with self._breakers_mutex:
+			self._breakers = {}
+		self._sessions.clear()
+		self._sessions.ttl = self._settings.get_int(["session_ttl"])
+		self._power_rings.resize(self._settings.get_int(["live_buffer_size"]))
+		self._thermal = self._build_thermal_monitor()
 
 		if old_debug_logging != new_debug_logging:
 			if new_debug_logging:
@@ -217,13 +246,73 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			else:
 				self._taposmartplug_logger.setLevel(logging.INFO)
 
-		if old_polling_value != new_polling_value or old_polling_timer != new_polling_timer:
+		if old_broker != new_broker:
+			self._stop_polling()
+			if self._broker is not None:
+				self._broker.close()
+			self._start_broker_client()
+			self._start_polling()
+		elif old_polling_value != new_polling_value or old_polling_timer != new_polling_timer:
+			self._start_polling()
+		elif self._broker is not None and new_polling_value:
+			# plugs may have been added or removed
+			self._start_polling()
+
+	##~~ Status polling
+
+	def _start_broker_client(self):
+		self._broker = None
+		if not self._settings.get_boolean(["broker_enabled"]):
+			return
+		from .broker import BrokerClient, default_socket_path
+
+		socket_path = self._settings.get(["broker_socket"]) or default_socket_path()
+		self._broker = BrokerClient(socket_path, self._taposmartplug_logger, on_event=self._on_broker_event,
+									spawn_args=["--session-ttl", str(self._settings.get_int(["session_ttl"])),
+												"--failure-threshold", str(self._settings.get_int(["breaker_failure_threshold"])),
+												"--reset-timeout", str(self._settings.get_int(["breaker_reset_timeout"])),
+												"--log-file", self._settings.get_plugin_logfile_path(postfix="broker")])
+
+	def _start_polling(self):
+		self._stop_polling()
+		if not self._settings.get_boolean(["pollingEnabled"]):
+			return
+		interval = int(self._settings.get(["pollingInterval"])) * 60
+		generation = self._poll_generation
+		if self._broker is not None:
+			plugs = [plug for plug in self._settings.get(["arrSmartplugs"]) if plug["ip"] != ""]
+			# connecting (and starting the broker) happens in the background, we only poll ourselves if that fails
+			self._broker.watch(plugs, interval, on_unavailable=lambda: self._start_local_polling(interval, generation))
+			self._taposmartplug_logger.debug("Asked the plug broker to poll %s plugs for us.", len(plugs))
+			return
+		self._start_local_polling(interval, generation)
+
+	def _start_local_polling(self, interval, generation):
+		with self._poll_mutex:
+			# polling was stopped or restarted since, or we are polling already
+			if generation != self._poll_generation or self.poll_status is not None:
+				return
+			if self._broker is not None:
+				self._taposmartplug_logger.info("Plug broker is unavailable, polling plugs directly.")
+			self.poll_status = RepeatedTimer(interval, self.check_statuses)
+			self.poll_status.start()
+
+	def _stop_polling(self):
+		with self._poll_mutex:
+			self._poll_generation += 1
 			if self.poll_status:
 				self.poll_status.cancel()
+				self.poll_status = None
+		if self._broker is not None:
+			self._broker.watch([], 0)
 
-			if new_polling_value:
-				self.poll_status = RepeatedTimer(int(self._settings.get(["pollingInterval"])) * 60, self.check_statuses)
-				self.poll_status.start()
+	def _on_broker_event(self, message):
+		if message.get("event") != "state":
+			return
+		if self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", message["ip"]) is None:
+			return
+		self._plugin_manager.send_plugin_message(self._identifier,
+												 self._device_status(message["ip"], message["result"]))
 
 	def get_settings_version(self):
 		return 13
@@ -240,10 +329,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 				plug["emeter"] = None
 				arrSmartplugs_new.append(plug)
 
-			self._taposmartplug_logger.info("Updating plug array, converting")
-			self._taposmartplug_logger.info(self._settings.get(['arrSmartplugs']))
-			self._taposmartplug_logger.info("to")
-			self._taposmartplug_logger.info(arrSmartplugs_new)
+			self._taposmartplug_logger.info("Updating plug array, converting %s", PlugSummary(arrSmartplugs_new))
 			self._settings.set(["arrSmartplugs"], arrSmartplugs_new)
 		elif current == 7:
 			# Loop through plug array and set emeter to None
@@ -252,10 +338,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 				plug["emeter"] = dict(get_realtime=False)
 				arrSmartplugs_new.append(plug)
 
-			self._taposmartplug_logger.info("Updating plug array, converting")
-			self._taposmartplug_logger.info(self._settings.get(['arrSmartplugs']))
-			self._taposmartplug_logger.info("to")
-			self._taposmartplug_logger.info(arrSmartplugs_new)
+			self._taposmartplug_logger.info("Updating plug array, converting %s", PlugSummary(arrSmartplugs_new))
 			self._settings.set(["arrSmartplugs"], arrSmartplugs_new)
 
 		if current is not None and current < 9:
@@ -323,32 +406,25 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 	def on_print_progress(self, storage, path, progress):
 		if self._settings.get_boolean(["progress_polling"]) is False:
 			return
-		self._taposmartplug_logger.debug("Checking statuses during print progress (%s)." % progress)
+		self._taposmartplug_logger.debug("Checking statuses during print progress (%s).", progress)
 		_print_progress_timer = threading.Timer(1, self.check_statuses)
 		_print_progress_timer.daemon = True
 		_print_progress_timer.start()
 		self._plugin_manager.send_plugin_message(self._identifier, dict(updatePlot=True))
 
-		if self.powerOffWhenIdle == True and not (self._skipIdleTimer == True):
-			self._taposmartplug_logger.debug("Resetting idle timer during print progress (%s)..." % progress)
-			self._waitForHeaters = False
-			self._reset_idle_timer()
+		if self.powerOffWhenIdle == True:
+			self._idle.activity("print progress")
 
 	##~~ SimpleApiPlugin mixin
 
 	def turn_on(self, plugip):
-		self._taposmartplug_logger.debug("Turning on %s." % plugip)
+		self._taposmartplug_logger.debug("Turning on %s.", plugip)
 		plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-		self._taposmartplug_logger.debug(plug)
-		plug_ip = plugip
-		plug_num = -1
-
-		p100 = PyP100.P100(plug["ip"], plug["username"], plug["password"]) #Creating a P100 plug object
+		self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 
-		p100.handshake() #Creates the cookies required for further methods
-		p100.login() #Sends credentials to the plug and creates AES Key and IV for further methods
-
-		p100.turnOn() #Sends the turn on request
+		status = self._plug_request(plug, lambda p100: self._switch(p100, plugip, True)) #Sends the turn on request
+		if status is None:
+			return self._remember_state(dict(currentState="unknown", ip=plugip))
 
 		if plug["autoConnect"] and self._printer.is_closed_or_error():
 			c = threading.Timer(int(plug["autoConnectDelay"]), self._printer.connect)
@@ -359,21 +435,19 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			t.daemon = True
 			t.start()
 		if self.powerOffWhenIdle == True and plug["automaticShutdownEnabled"] == True:
-			self._taposmartplug_logger.debug("Resetting idle timer since plug %s was just turned on." % plugip)
-			self._waitForHeaters = False
-			self._reset_idle_timer()
+			self._taposmartplug_logger.debug("Resetting idle timeout since plug %s was just turned on.", plugip)
+			self._idle.activity("plug turned on")
 
-		return self.check_status(plugip)
+		return status
 
 	def turn_off(self, plugip):
 		timenow = datetime.now()
-		self._taposmartplug_logger.debug("Turning off %s." % plugip)
-		self._taposmartplug_logger.info("Turning off %s at %s" % (plugip, timenow))
+		self._taposmartplug_logger.debug("Turning off %s.", plugip)
+		self._taposmartplug_logger.info("Turning off %s at %s", plugip, timenow)
 		plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-		self._taposmartplug_logger.debug(plug)
-		plug_ip = plugip
-		plug_num = -1
+		self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 
+		# the local side effects run even if the plug is unreachable, only the device request fails fast
 		if plug["sysCmdOff"]:
 			t = threading.Timer(int(plug["sysCmdOffDelay"]), os.system, args=[plug["sysRunCmdOff"]])
 			t.daemon = True
@@ -382,64 +456,296 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			self._printer.disconnect()
 			time.sleep(int(plug["autoDisconnectDelay"]))
 
-		p100 = PyP100.P100(plug["ip"], plug["username"], plug["password"]) #Creating a P100 plug object
-
-		p100.handshake() #Creates the cookies required for further methods
-		p100.login() #Sends credentials to the plug and creates AES Key and IV for further methods
+		status = self._plug_request(plug, lambda p100: self._switch(p100, plugip, False)) #Sends the turn off request
+		if status is None:
+			return self._remember_state(dict(currentState="unknown", ip=plugip))
 
-		p100.turnOff() #Sends the turn on request
+		self._idle.disarm("plug turned off")
+		return status
 
-		self._stop_idle_timer()
-		return self.check_status(plugip)
+	def _switch(self, p100, plugip, on):
+		"""Switches plugip and reads the resulting state back over the same session."""
+		set_device_on(p100, plugip, on)
+		state = "on" if on else "off"
+		# the plug accepted the command, show it right away instead of after the read back
+		self._plugin_manager.send_plugin_message(self._identifier,
+												 self._remember_state(dict(currentState=state, ip=plugip)))
+		try:
+			return self._device_status(plugip, self._get_device_info(p100, plugip))
+		except Exception as e:
+			self._taposmartplug_logger.debug("Could not read back the state of %s: %s", plugip, e)
+			return self._remember_state(dict(currentState=state, ip=plugip))
 
 	def check_statuses(self):
+		strips = {}
 		for plug in self._settings.get(["arrSmartplugs"]):
-			chk = self.check_status(plug["ip"], plug["username"], plug["password"])
+			if outlet_index(plug["ip"]) is not None:
+				strips.setdefault(plug_host(plug["ip"]), []).append(plug)
+				continue
+			chk = self.check_status(plug["ip"])
 			self._plugin_manager.send_plugin_message(self._identifier, chk)
+		for outlets in strips.values():
+			for chk in self._check_outlet_statuses(outlets):
+				self._plugin_manager.send_plugin_message(self._identifier, chk)
+
+	def _check_outlet_statuses(self, outlets):
+		"""Statuses of several outlets of one strip from a single get_child_device_list request."""
+		children = self._plug_request(outlets[0], get_child_device_list)
+		statuses = []
+		for plug in outlets:
+			try:
+				statuses.append(self._device_status(plug["ip"], outlet_info(children, plug["ip"])))
+			except Exception as e:
+				self._taposmartplug_logger.debug("No state for %s: %s", plug["ip"], e)
+				statuses.append(self._remember_state(dict(currentState="unknown", ip=plug["ip"])))
+		return statuses
 
 	def check_status(self, plugip):
-		self._taposmartplug_logger.debug("Checking status of %s." % plugip)
+		self._taposmartplug_logger.debug("Checking status of %s.", plugip)
 		if plugip != "":
 			today = datetime.today()
 
 			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
 
-			p100 = PyP100.P100(plug["ip"], plug["username"], plug["password"]) #Creating a P100 plug object
-			p100.handshake() #Creates the cookies required for further methods
-			p100.login() #Sends credentials to the plug and creates AES Key and IV for further methods
-			response = p100.getDeviceInfo() #Returns dict with all the device info
+			response = self._plug_request(plug, lambda p100: self._get_device_info(p100, plugip)) #Returns dict with all the device info
+			if response is None:
+				return self._remember_state(dict(currentState="unknown", ip=plugip))
+			return self._device_status(plugip, response)
+
+	def _device_status(self, plugip, response):
+		chk = self.lookup(response, *["result", "device_on"])
+
+		if chk == 1:
+			status = dict(currentState="on", ip=plugip)
+		elif chk == 0:
+			status = dict(currentState="off", ip=plugip)
+		else:
+			self._taposmartplug_logger.debug("Unexpected device info from %s: %s", plugip,
+											 PlugSummary(self.lookup(response, "result"), keys=["model", "fw_ver", "device_on"]))
+			return self._remember_state(dict(currentState="unknown", ip=plugip))
+
+		energy_usage = self.lookup(response, *["energy_usage", "result"])
+		if energy_usage:
+			self._record_energy_usage(plugip, energy_usage)
+			status["emeter"] = dict(get_realtime=dict(power_mw=energy_usage.get("current_power", 0),
+													  total_wh=energy_usage.get("month_energy", 0),
+													  cost=self._month_cost(plugip, energy_usage.get("month_energy", 0) / 1000.0),
+													  err_code=0))
+		return self._remember_state(status)
+
+	def _month_cost(self, plugip, month_kwh):
+		"""Cost of the month so far with the configured tariff, flat rate on the device total without history."""
+		if self._energy_store is not None:
+			try:
+				month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+				return round(self._energy_cost(plugip, month_start.strftime(TIMESTAMP_FORMAT),
+											   datetime.now().strftime(TIMESTAMP_FORMAT))[1], 4)
+			except Exception:
+				self._taposmartplug_logger.exception("Could not calculate the cost of %s.", plugip)
+		return round(month_kwh * self._get_tariff(plugip).default_rate, 4)
+
+	def _remember_state(self, status):
+		"""Caches the latest status of a plug for the bulk status endpoint and returns it."""
+		with self._plug_states_mutex:
+			previous = self._plug_states.get(status["ip"])
+			if previous is None or previous["currentState"] != status["currentState"] \
+					or previous.get("emeter") != status.get("emeter"):
+				self._state_version += 1
+			self._plug_states[status["ip"]] = dict(status, last_seen=time.time())
+		return status
+
+	def _plug_states_etag(self):
+		with self._plug_states_mutex:
+			return '"%s-%s"' % (self._state_epoch, self._state_version)
+
+	def _all_plug_states(self):
+		with self._plug_states_mutex:
+			version = self._state_version
+			states = dict(self._plug_states)
+		plugs = []
+		for plug in self._settings.get(["arrSmartplugs"]):
+			if plug["ip"] != "":
+				plugs.append(states.get(plug["ip"], dict(currentState="unknown", ip=plug["ip"], last_seen=None)))
+		return dict(version=version, plugs=plugs)
+
+	##~~ Device access
+
+	def _get_device_info(self, p100, plugip=None):
+		return get_device_info(p100, self._taposmartplug_logger, plugip)
+
+	def _tapo_request(self, p100, method, params=None):
+		return tapo_request(p100, method, params)
+
+	def _get_breaker(self, plugip):
+		host = plug_host(plugip)
+		with self._breakers_mutex:
+			breaker = self._breakers.get(host)
+			if breaker is None:
+				def on_change(old_state, new_state):
+					self._taposmartplug_logger.info(
+						"Circuit breaker for %s changed from %s to %s.", host, old_state, new_state)
+					if new_state == CircuitBreaker.CLOSED:
+						self._start_energy_backfill(host)
+				breaker = CircuitBreaker(self._settings.get_int(["breaker_failure_threshold"]),
+										 self._settings.get_int(["breaker_reset_timeout"]),
+										 on_change=on_change, probe=lambda: self._probe_host(host))
+				self._breakers[host] = breaker
+			return breaker
+
+	def _probe_host(self, host):
+		"""Background probe of an open circuit breaker, returns True if the device answered."""
+		plug = next((plug for plug in self._settings.get(["arrSmartplugs"]) if plug_host(plug["ip"]) == host), None)
+		if plug is None:
+			return False
+		try:
+			self._run_on_session(plug, lambda p100: p100.getDeviceInfo())
+			return True
+		except Exception as e:
+			self._sessions.invalidate(plug)
+			self._taposmartplug_logger.debug("%s is still unreachable: %s", host, e)
+			return False
+
+	def _plug_request(self, plug, action):
+		"""
+		Runs action on an authenticated session to plug, reusing a pre-warmed session if there is one. Returns
+		None without touching the network until the plug's circuit breaker is closed again, or when the device
+		could not be reached.
+		"""
+		if plug is None:
+			return None
+		breaker = self._get_breaker(plug["ip"])
+		if not breaker.allow():
+			self._taposmartplug_logger.debug("Circuit breaker for %s is not closed, failing fast.", plug["ip"])
+			return None
+		try:
+			result = self._run_on_session(plug, action)
+		except Exception as e:
+			self._sessions.invalidate(plug)
+			breaker.record_failure()
+			self._taposmartplug_logger.debug("Could not reach %s: %s", plug["ip"], e)
+			return None
+		breaker.record_success()
+		return result if result is not None else True
+
+	def _run_on_session(self, plug, action):
+		if self._broker is not None:
+			from .broker import BrokerSession, BrokerUnavailable
 
-			chk = self.lookup(response, *["result", "device_on"])
+			try:
+				return action(BrokerSession(self._broker, plug))
+			except BrokerUnavailable as e:
+				self._taposmartplug_logger.debug("Plug broker unavailable (%s), talking to %s directly.", e, plug["ip"])
 
-			self._taposmartplug_logger.debug(chk)
+		p100, cached = self._sessions.get(plug)
+		try:
+			return action(p100)
+		except Exception as e:
+			if not cached:
+				raise
+			# the plug may have dropped the session, retry once with a fresh login
+			self._taposmartplug_logger.debug("Cached session for %s failed (%s), logging in again.", plug["ip"], e)
+			self._sessions.invalidate(plug)
+			p100, cached = self._sessions.get(plug)
+			return action(p100)
+
+	def _prewarm_sessions(self, predicate):
+		"""Logs in to every matching reachable plug in the background ahead of an expected command."""
+		if self._broker is not None:
+			from .broker import credentials
 
-			if chk == 1:
-				return dict(currentState="on", ip=plugip)
-			elif chk == 0:
-				return dict(currentState="off", ip=plugip)
-			else:
-				self._taposmartplug_logger.debug(response)
-				return dict(currentState="unknown", ip=plugip)
+		for plug in self._settings.get(["arrSmartplugs"]):
+			if predicate(plug) and plug["ip"] != "" and self._get_breaker(plug["ip"]).available():
+				if self._broker is None or not self._broker.notify("warm", plug=credentials(plug)):
+					self._sessions.warm(plug)
 
 	def get_api_commands(self):
 		return dict(
 			turnOn=["ip"],
 			turnOff=["ip"],
 			checkStatus=["ip"],
+			getEnergyData=["ip"],
+			discoverPlugs=[],
 			enableAutomaticShutdown=[],
 			disableAutomaticShutdown=[],
-			abortAutomaticShutdown=[])
+			abortAutomaticShutdown=[],
+			startProfiler=[],
+			stopProfiler=[])
 
 	def on_api_get(self, request):
 		self._taposmartplug_logger.debug(request.args)
 		if request.args.get("checkStatus"):
 			response = self.check_status(request.args.get("checkStatus"))
 			return flask.jsonify(response)
+		if request.args.get("export"):
+			from urllib.parse import urlencode
+
+			# exports are streamed by the tornado route, flask would buffer the whole file
+			args = request.args.to_dict()
+			args["ip"] = args.pop("export")
+			return flask.redirect("%s/plugin/%s/export?%s" % (request.script_root, self._identifier, urlencode(args)),
+								  code=307)
+		if request.args.get("cost"):
+			try:
+				start = normalize_timestamp(request.args.get("start"))
+				end = normalize_timestamp(request.args.get("end", datetime.now().strftime(TIMESTAMP_FORMAT)))
+			except ValueError as e:
+				return flask.make_response(str(e), 400)
+			energy, cost = self._energy_cost(request.args.get("cost"), start, end)
+			return flask.jsonify(dict(ip=request.args.get("cost"), start=start, end=end, energy=energy, cost=cost))
+		if request.args.get("statuses"):
+			# the version only moves when a state or power reading changes, so unchanged polls cost a 304
+			etag = self._plug_states_etag()
+			if etag in request.headers.get("If-None-Match", ""):
+				response = flask.make_response("", 304)
+			else:
+				response = flask.jsonify(self._all_plug_states())
+			response.headers["ETag"] = etag
+			response.headers["Cache-Control"] = "no-cache"
+			return response
+		if request.args.get("live"):
+			try:
+				seconds = float(request.args.get("seconds")) if request.args.get("seconds") else None
+			except ValueError:
+				return flask.make_response("Invalid seconds", 400)
+			return flask.jsonify(self._power_rings.snapshot(request.args.get("live"), seconds))
+		if request.args.get("idleState"):
+			return flask.jsonify(dict(self._idle.snapshot(), powerOffWhenIdle=self.powerOffWhenIdle))
+		if request.args.get("profiler"):
+			if not Permissions.ADMIN.can():
+				return flask.make_response("Insufficient rights", 403)
+			return flask.jsonify(self._profiler.status())
+		if request.args.get("loadTimes"):
+			return flask.jsonify(self._load_times)
+		if request.args.get("job"):
+			with self._jobs_mutex:
+				job = self._jobs.get(request.args.get("job"))
+				if job is None:
+					return flask.make_response("Unknown job", 404)
+				return flask.jsonify(dict(job))
 
 	def on_api_command(self, command, data):
+		if command in ["startProfiler", "stopProfiler"]:
+			return self._profiler_command(command, data)
 		if not Permissions.PLUGIN_TAPOSMARTPLUG_CONTROL.can():
 			return flask.make_response("Insufficient rights", 403)
 
+		if command in ["turnOn", "turnOff", "checkStatus"] and data.get("async", False):
+			job = self._submit_job(command, "{ip}".format(**data))
+			return flask.make_response(flask.jsonify(job), 202)
+
+		if command == "discoverPlugs":
+			if data.get("cidr"):
+				from .discovery import parse_network
+
+				try:
+					parse_network(data.get("cidr"))
+				except ValueError as e:
+					return flask.make_response(str(e), 400)
+			discover = lambda: self._discover_plugs(data.get("cidr"), data.get("username"), data.get("password"))
+			if data.get("async", False):
+				return flask.make_response(flask.jsonify(self._submit_job(command, "", work=discover)), 202)
+			return flask.jsonify(discover())
+
 		if command == 'turnOn':
 			response = self.turn_on("{ip}".format(**data))
 			self._plugin_manager.send_plugin_message(self._identifier, response)
@@ -448,21 +754,19 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			self._plugin_manager.send_plugin_message(self._identifier, response)
 		elif command == 'checkStatus':
 			response = self.check_status("{ip}".format(**data))
+		elif command == 'getEnergyData':
+			response = dict(ip="{ip}".format(**data),
+							energy_data=self._energy_data_with_cost("{ip}".format(**data),
+																	int(data.get("record_limit", 10)),
+																	int(data.get("record_offset", 0))))
 		elif command == 'enableAutomaticShutdown':
 			self.powerOffWhenIdle = True
-			self._reset_idle_timer()
+			self._idle.enable("enabled from the ui")
 		elif command == 'disableAutomaticShutdown':
 			self.powerOffWhenIdle = False
-			self._stop_idle_timer()
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._timeout_value = None
+			self._idle.disable("disabled from the ui")
 		elif command == 'abortAutomaticShutdown':
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._timeout_value = None
+			self._idle.activity("aborted from the ui")
 			for plug in self._settings.get(["arrSmartplugs"]):
 				if plug["useCountdownRules"] and int(plug["countdownOffDelay"]) > 0:
 					if "/" in plug["ip"]:
@@ -471,52 +775,407 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 						plug_ip = plug["ip"]
 						plug_num = -1
 					self.sendCommand(json.loads('{"count_down":{"delete_all_rules":null}}'), plug_ip, plug_num)
-					self._taposmartplug_logger.debug("Cleared countdown rules for %s" % plug["ip"])
+					self._taposmartplug_logger.debug("Cleared countdown rules for %s", plug["ip"])
 			self._taposmartplug_logger.debug("Power off aborted.")
-			self._taposmartplug_logger.debug("Restarting idle timer.")
-			self._reset_idle_timer()
 		else:
 			response = dict(ip=data.ip, currentState="unknown")
 		if command == "enableAutomaticShutdown" or command == "disableAutomaticShutdown":
-			self._taposmartplug_logger.debug("Automatic power off setting changed: %s" % self.powerOffWhenIdle)
+			self._taposmartplug_logger.debug("Automatic power off setting changed: %s", self.powerOffWhenIdle)
 			self._settings.set_boolean(["powerOffWhenIdle"], self.powerOffWhenIdle)
 			self._settings.save()
 		# eventManager().fire(Events.SETTINGS_UPDATED)
 		if command == "enableAutomaticShutdown" or command == "disableAutomaticShutdown" or command == "abortAutomaticShutdown":
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
+			self._send_idle_state()
 		else:
 			return flask.jsonify(response)
 
+	def _profiler_command(self, command, data):
+		"""
+		Admins can sample where the plugin's threads and hooks spend their time for a window of up to
+		10 minutes, the collapsed stacks end up in the profiles folder of the plugin data folder.
+		"""
+		if not Permissions.ADMIN.can():
+			return flask.make_response("Insufficient rights", 403)
+		if command == "stopProfiler":
+			return flask.jsonify(self._profiler.stop())
+		try:
+			duration = min(max(float(data.get("seconds", 60)), 1), 600)
+			interval = min(max(float(data.get("interval_ms", 10)), 1), 1000) / 1000.0
+		except (TypeError, ValueError):
+			return flask.make_response("Invalid seconds or interval_ms", 400)
+		return flask.jsonify(self._profiler.start(duration, interval))
+
+	##~~ Energy data export
+
+	def _export_energy_data(self, plugip, start=None, end=None, export_format=None, aggregate=None):
+		"""
+		Returns (status, body, mimetype, filename) for the export route. On success body is a generator of
+		text chunks, otherwise an error message.
+		"""
+		export_format = export_format or "csv"
+		if not plugip:
+			return 400, "Missing ip", "text/plain", None
+		if export_format not in ["csv", "ndjson"]:
+			return 400, "Unknown format %s" % export_format, "text/plain", None
+		if aggregate not in [None, "", "hour", "day"]:
+			return 400, "Unknown aggregate %s" % aggregate, "text/plain", None
+		if self._energy_store is None:
+			return 503, "Energy database not available", "text/plain", None
+
+		try:
+			start = normalize_timestamp(start) if start else None
+			end = normalize_timestamp(end) if end else None
+		except ValueError as e:
+			return 400, str(e), "text/plain", None
+
+		baseline = self._energy_store.last_total_before(plugip, start) if start else None
+		# samples are priced one by one and only then grouped, a bucket can span several tariff bands
+		costed = self._get_tariff(plugip).iter_costs(self._energy_store.iter_samples(plugip, start, end),
+													 baseline, start)
+		if aggregate:
+			costed = aggregate_costs(costed, aggregate)
+		rows = (list(row) + [energy, cost] for row, energy, cost in costed)
+		columns = ["timestamp", "current", "power", "total", "voltage", "energy", "cost"]
+
+		def generate_csv():
+			import csv
+			import io
+
+			buffer = io.StringIO()
+			writer = csv.writer(buffer)
+			writer.writerow(["ip"] + columns)
+			for row in rows:
+				writer.writerow([plugip] + row)
+				if buffer.tell() > 8192:
+					yield buffer.getvalue()
+					buffer.seek(0)
+					buffer.truncate()
+			yield buffer.getvalue()
+
+		def generate_ndjson():
+			lines = []
+			for row in rows:
+				record = dict(zip(columns, row))
+				record["ip"] = plugip
+				lines.append(json.dumps(record) + "\n")
+				if len(lines) >= 100:
+					yield "".join(lines)
+					lines = []
+			yield "".join(lines)
+
+		filename = "energy_data_%s.%s" % (plugip.replace("/", "_"), export_format)
+		if export_format == "csv":
+			return 200, generate_csv(), "text/csv", filename
+		return 200, generate_ndjson(), "application/x-ndjson", filename
+
+	def route_hook(self, server_routes, *args, **kwargs):
+		from octoprint.server import app
+		from octoprint.server.util.flask import permission_validator
+		from octoprint.server.util.tornado import access_validation_factory
+		from .export import export_handler
+
+		return [
+			(r"/export", export_handler(),
+			 dict(export=self._export_energy_data,
+				  access_validation=access_validation_factory(app, permission_validator,
+															  Permissions.PLUGIN_TAPOSMARTPLUG_CONTROL)))
+		]
+
+	##~~ Energy cost
+
+	def _get_tariff(self, plugip):
+		plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip) or dict()
+		rate = plug.get("cost_rate")
+		if rate in [None, ""]:
+			rate = self._settings.get_float(["cost_rate"])
+		bands = self._settings.get(["tariff_bands"]) or []
+
+		key = (float(rate or 0), json.dumps(bands, sort_keys=True))
+		tariff = self._tariffs.get(key)
+		if tariff is None:
+			tariff = Tariff(rate, bands)
+			self._tariffs[key] = tariff
+		return tariff
+
+	def _cost_configured(self):
+		return self._settings.get_float(["cost_rate"]) > 0 or len(self._settings.get(["tariff_bands"]) or []) > 0
+
+	def _energy_cost(self, plugip, start, end):
+		"""Returns (kWh, cost) for plugip between start and end, reusing results for past days."""
+		tariff = self._get_tariff(plugip)
+		now = datetime.now().strftime(TIMESTAMP_FORMAT)
+		# while old rows are still being converted the history is incomplete, nothing is cached until it is done
+		cacheable = self._energy_store.migrated.is_set()
+		energy = cost = 0.0
+		for segment_start, segment_end in day_segments(start, end):
+			key = (plugip, segment_start, segment_end, tariff.key)
+			result = self._cost_cache.get(key)
+			if result is None:
+				baseline = self._energy_store.last_total_before(plugip, segment_start)
+				result = tariff.cost(self._energy_store.iter_samples(plugip, segment_start, segment_end), baseline,
+									 segment_start)
+				if cacheable and segment_end <= now:
+					self._cost_cache.put(key, result)
+			energy += result[0]
+			cost += result[1]
+		return energy, cost
+
+	def _energy_data_with_cost(self, plugip, limit, offset=0):
+		rows = self._energy_store.latest_samples(plugip, limit, offset)
+		if not rows:
+			return []
+		baseline = self._energy_store.last_total_before(plugip, rows[0][0])
+		energy_data = []
+		cumulative_cost = 0.0
+		for row, energy, cost in self._get_tariff(plugip).iter_costs(rows, baseline):
+			cumulative_cost += cost
+			energy_data.append(list(row[:4]) + [cumulative_cost])
+		return energy_data
+
+	##~~ Energy history
+
+	def _record_energy_usage(self, plugip, energy_usage):
+		self._power_rings.append(plugip, energy_usage.get("current_power", 0) / 1000.0,
+								 energy_usage.get("month_energy", 0) / 1000.0)
+		if self._energy_store is None:
+			return
+		# total is the device's month to date counter, the cost engine treats its monthly reset as a counter reset
+		sample = [int(time.time()), None, energy_usage.get("current_power", 0) / 1000.0,
+				  energy_usage.get("month_energy", 0) / 1000.0, None]
+		try:
+			self._energy_store.insert_samples(plugip, [sample])
+		except Exception:
+			self._taposmartplug_logger.exception("Could not store energy sample for %s.", plugip)
+
+	def _start_energy_backfill(self, host=None):
+		for plug in self._settings.get(["arrSmartplugs"]):
+			plugip_host = plug_host(plug["ip"])
+			# strip outlets have no energy history of their own
+			if plugip_host == "" or outlet_index(plug["ip"]) is not None or (host is not None and plugip_host != host):
+				continue
+			with self._backfills_mutex:
+				if plug["ip"] in self._backfills_running:
+					continue
+				self._backfills_running.add(plug["ip"])
+			t = threading.Thread(target=self._backfill_energy, args=[plug])
+			t.daemon = True
+			t.start()
+
+	def _backfill_energy(self, plug):
+		"""
+		Pulls the hourly energy history the plug keeps itself and merges it into energy_data, so gaps in our
+		own sampling do not lose kWh. Rows are written at the end of each hour with the month to date total,
+		which is what live samples store as well.
+		"""
+		try:
+			days = self._settings.get_int(["energy_backfill_days"])
+			if days <= 0:
+				return
+			samples = self._plug_request(plug, lambda p100: self._fetch_energy_history(p100, days))
+			if not samples:
+				return
+			added = self._energy_store.insert_samples(plug["ip"], samples)
+			if added:
+				self._cost_cache.invalidate(plug["ip"])
+			self._taposmartplug_logger.debug("Backfilled %s energy samples for %s.", added, plug["ip"])
+		except Exception:
+			self._taposmartplug_logger.exception("Energy backfill for %s failed.", plug["ip"])
+		finally:
+			with self._backfills_mutex:
+				self._backfills_running.discard(plug["ip"])
+
+	def _fetch_energy_history(self, p100, days):
+		if not has_energy_monitoring(p100.getDeviceInfo()):
+			return []
+
+		now = datetime.now()
+		first_day = datetime(now.year, now.month, now.day) - timedelta(days=days - 1)
+
+		# daily buckets are only served per quarter, counted from the quarter's first day. They give the
+		# month to date total at the start of every day, including months before the current one.
+		daily_wh = {}
+		quarter = datetime(first_day.year, (first_day.month - 1) // 3 * 3 + 1, 1)
+		while quarter <= now:
+			next_quarter = datetime(quarter.year + quarter.month // 10, (quarter.month + 2) % 12 + 1, 1)
+			daily = self._tapo_request(p100, "get_energy_data", dict(start_timestamp=int(time.mktime(quarter.timetuple())),
+																	 end_timestamp=int(time.mktime(min(next_quarter, now).timetuple())),
+																	 interval=1440))
+			for index, wh in enumerate(self.lookup(daily, *["result", "data"]) or []):
+				daily_wh[(quarter + timedelta(days=index)).date()] = wh
+			quarter = next_quarter
+
+		def month_to_date_wh(day):
+			month_start = day.replace(day=1)
+			return sum(daily_wh.get(month_start + timedelta(days=i), 0) for i in range(day.day - 1))
+
+		samples = []
+		chunk_start = first_day
+		while chunk_start <= now:
+			# hourly buckets come in windows of up to 8 days per request
+			chunk_end = min(chunk_start + timedelta(days=8), datetime(now.year, now.month, now.day) + timedelta(days=1))
+			hourly = self._tapo_request(p100, "get_energy_data", dict(start_timestamp=int(time.mktime(chunk_start.timetuple())),
+																	  end_timestamp=int(time.mktime(chunk_end.timetuple())),
+																	  interval=60))
+			day = None
+			month_wh = 0
+			# buckets are counted in epoch hours, so the repeated hour at the end of daylight saving time
+			# gets a timestamp of its own
+			chunk_epoch = int(time.mktime(chunk_start.timetuple()))
+			for hour, wh in enumerate(self.lookup(hourly, *["result", "data"]) or []):
+				hour_end = chunk_epoch + (hour + 1) * 3600
+				if hour_end > time.time():
+					break
+				hour_start = datetime.fromtimestamp(hour_end - 3600)
+				if hour_start.date() != day:
+					day = hour_start.date()
+					month_wh = month_to_date_wh(day)
+				month_wh += wh
+				samples.append([hour_end, None, float(wh), month_wh / 1000.0, None])
+			chunk_start = chunk_end
+		return samples
+
+	##~~ Discovery
+
+	def _discover_plugs(self, cidr=None, username=None, password=None):
+		from .discovery import PlugDiscovery
+
+		devices = PlugDiscovery(self._taposmartplug_logger).discover(cidr)
+		self._taposmartplug_logger.debug("Discovered %s devices.", len(devices))
+
+		# alias and outlets of Tapo devices are only available after logging in
+		if username and password:
+			threads = []
+			for device in devices:
+				if device["protocol"] == "tapo":
+					t = threading.Thread(target=self._describe_tapo_device, args=[device, username, password])
+					t.daemon = True
+					t.start()
+					threads.append(t)
+			deadline = time.time() + 10
+			for t in threads:
+				t.join(max(0, deadline - time.time()))
+		return dict(devices=devices)
+
+	def _describe_tapo_device(self, device, username, password):
+		import base64
+
+		def describe(p100):
+			info = self.lookup(p100.getDeviceInfo(), "result") or {}
+			children = []
+			if info.get("type", "").endswith("STRIP") or device["model"].startswith("P300"):
+				children = get_child_device_list(p100)
+			return info, children
+
+		result = self._plug_request(dict(ip=device["ip"], username=username, password=password), describe)
+		if not result:
+			return
+
+		def decode(nickname):
+			try:
+				return base64.b64decode(nickname).decode("utf-8")
+			except Exception:
+				return nickname
+
+		info, children = result
+		device["alias"] = decode(info.get("nickname", ""))
+		device["children"] = [dict(index=index, id=child.get("device_id"), alias=decode(child.get("nickname", "")),
+								   state=child.get("device_on"))
+							  for index, child in enumerate(children)]
+
+	##~~ Startup power on
+
+	def _startup_power_on(self, reason):
+		# on_after_startup and the STARTUP event both request this, only the first one wins
+		with self._startup_power_on_mutex:
+			if self._startup_power_on_started:
+				self._taposmartplug_logger.debug("Startup power on already triggered, ignoring %s.", reason)
+				return
+			self._startup_power_on_started = True
+
+		self._taposmartplug_logger.debug("powering on due to %s.", reason)
+		for plug in self._settings.get(['arrSmartplugs']):
+			if plug["event_on_startup"] is True:
+				t = threading.Thread(target=self._startup_power_on_plug, args=[plug["ip"], reason])
+				t.daemon = True
+				t.start()
+
+	def _startup_power_on_plug(self, plugip, reason):
+		self._taposmartplug_logger.debug("powering on %s due to %s.", plugip, reason)
+		response = self.turn_on(plugip)
+		if response.get("currentState", False) == "on":
+			self._plugin_manager.send_plugin_message(self._identifier, response)
+		else:
+			self._taposmartplug_logger.debug("powering on %s during %s failed.", plugip, reason)
+
+	##~~ Background jobs
+
+	def _submit_job(self, command, plugip, work=None):
+		job = dict(id=uuid.uuid4().hex, command=command, ip=plugip, status="queued", result=None,
+				   created=time.time(), finished=None)
+		with self._jobs_mutex:
+			self._jobs[job["id"]] = job
+			# keep the registry bounded, dropping the oldest finished jobs first
+			finished = [j for j in self._jobs.values() if j["finished"] is not None]
+			for old_job in sorted(finished, key=lambda j: j["finished"])[:max(0, len(self._jobs) - 50)]:
+				del self._jobs[old_job["id"]]
+			queued = dict(job)
+
+		t = threading.Thread(target=self._run_job, args=[job["id"], work])
+		t.daemon = True
+		t.start()
+		return queued
+
+	def _run_job(self, job_id, work=None):
+		with self._jobs_mutex:
+			job = self._jobs[job_id]
+			job["status"] = "running"
+			command = job["command"]
+			plugip = job["ip"]
+
+		try:
+			if work is not None:
+				response = work()
+			elif command == "turnOn":
+				response = self.turn_on(plugip)
+				self._plugin_manager.send_plugin_message(self._identifier, response)
+			elif command == "turnOff":
+				response = self.turn_off(plugip)
+				self._plugin_manager.send_plugin_message(self._identifier, response)
+			else:
+				response = self.check_status(plugip)
+			status = "done"
+		except Exception as e:
+			self._taposmartplug_logger.exception("Job %s (%s %s) failed.", job_id, command, plugip)
+			response = dict(currentState="unknown", ip=plugip, error=str(e))
+			status = "failed"
+
+		with self._jobs_mutex:
+			job["status"] = status
+			job["result"] = response
+			job["finished"] = time.time()
+			finished = dict(job)
+		self._plugin_manager.send_plugin_message(self._identifier, dict(type="job", job=finished))
+
 	##~~ EventHandlerPlugin mixin
 
 	def on_event(self, event, payload):
 		# Startup Event
 		if event == Events.STARTUP and self._settings.get_boolean(["event_on_startup_monitoring"]) is True:
-			self._taposmartplug_logger.debug("powering on due to %s event." % event)
-			for plug in self._settings.get(['arrSmartplugs']):
-				if plug["event_on_startup"] is True:
-					self._taposmartplug_logger.debug("powering on %s due to %s event." % (plug["ip"], event))
-					response = self.turn_on(plug["ip"])
-					if response["currentState"] == "on":
-						self._plugin_manager.send_plugin_message(self._identifier, response)
+			self._startup_power_on(event)
 		# Error Event
 		if event == Events.ERROR and self._settings.getBoolean(["event_on_error_monitoring"]) is True:
-			self._taposmartplug_logger.debug("powering off due to %s event." % event)
+			self._taposmartplug_logger.debug("powering off due to %s event.", event)
 			for plug in self._settings.get(['arrSmartplugs']):
 				if plug["event_on_error"] is True:
-					self._taposmartplug_logger.debug("powering off %s due to %s event." % (plug["ip"], event))
+					self._taposmartplug_logger.debug("powering off %s due to %s event.", plug["ip"], event)
 					response = self.turn_off(plug["ip"])
 					if response["currentState"] == "off":
 						self._plugin_manager.send_plugin_message(self._identifier, response)
 		# Client Opened Event
 		if event == Events.CLIENT_OPENED:
 			if self._settings.get_boolean(["powerOffWhenIdle"]):
-				self._reset_idle_timer()
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
+				self._idle.activity("client opened", abort=False)
+			self._send_idle_state()
 			return
 		# Cancelled Print Interpreted Event
 		if event == Events.PRINT_FAILED and not self._printer.is_closed_or_error():
@@ -524,21 +1183,14 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			self.print_job_started = False
 			return
 		# Print Started Event
-		if event == Events.PRINT_STARTED and self._settings.getFloat(["cost_rate"]) > 0:
+		if event == Events.PRINT_STARTED and self._cost_configured():
 			self.print_job_started = True
+			self._print_started_at = datetime.now().strftime(TIMESTAMP_FORMAT)
 			self._taposmartplug_logger.debug(payload.get("path", None))
 
 		if event == Events.PRINT_STARTED and self.powerOffWhenIdle is True:
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-				self._taposmartplug_logger.debug("Power off aborted because starting new print.")
-			if self._idleTimer is not None:
-				self._reset_idle_timer()
-			self._timeout_value = None
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
+			self._idle.activity("print started")
+			self._send_idle_state()
 
 		if event == Events.PRINT_STARTED and self._countdown_active:
 			for plug in self._settings.get(["arrSmartplugs"]):
@@ -549,7 +1201,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 						plug_ip = plug["ip"]
 						plug_num = -1
 					self.sendCommand(json.loads('{"count_down":{"delete_all_rules":null}}'), plug_ip, plug_num)
-					self._taposmartplug_logger.debug("Cleared countdown rules for %s" % plug["ip"])
+					self._taposmartplug_logger.debug("Cleared countdown rules for %s", plug["ip"])
 		# Print Done Event
 		if event == Events.PRINT_DONE and self.print_job_started:
 			self._taposmartplug_logger.debug(payload)
@@ -559,114 +1211,88 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 
 			self._storage_interface = self._file_manager._storage(payload.get("origin", "local"))
 
+			if self._print_started_at and self._energy_store is not None and payload.get("path"):
+				print_ended_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+				power_cost = 0.0
+				for plug in self._settings.get(["arrSmartplugs"]):
+					power_cost += self._energy_cost(plug["ip"], self._print_started_at, print_ended_at)[1]
+				self._taposmartplug_logger.debug("Power cost for %s: %s", payload.get("path"), power_cost)
+				self._storage_interface.set_additional_metadata(payload.get("path"), "statistics",
+																dict(lastPowerCost=dict(_default=float('{:.4f}'.format(power_cost)))),
+																merge=True)
+
 			self.print_job_started = False
+			self._print_started_at = None
 
 		if self.powerOffWhenIdle == True and event == Events.MOVIE_RENDERING:
-			self._taposmartplug_logger.debug("Timelapse generation started: %s" % payload.get("movie_basename", ""))
+			self._taposmartplug_logger.debug("Timelapse generation started: %s", payload.get("movie_basename", ""))
 			self._timelapse_active = True
 
 		if self._timelapse_active and event == Events.MOVIE_DONE or event == Events.MOVIE_FAILED:
-			self._taposmartplug_logger.debug("Timelapse generation finished: %s. Return Code: %s" % (
-				payload.get("movie_basename", ""), payload.get("returncode", "completed")))
+			self._taposmartplug_logger.debug("Timelapse generation finished: %s. Return Code: %s",
+											 payload.get("movie_basename", ""), payload.get("returncode", "completed"))
 			self._timelapse_active = False
 		# Printer Connected Event
 		if event == Events.CONNECTED:
 			if self._autostart_file:
-				self._taposmartplug_logger.debug("printer connected starting print of %s" % self._autostart_file)
+				self._taposmartplug_logger.debug("printer connected starting print of %s", self._autostart_file)
 				self._printer.select_file(self._autostart_file, False, printAfterSelect=True)
 				self._autostart_file = None
 		# File Uploaded Event
 		if event == Events.UPLOAD and self._settings.getBoolean(["event_on_upload_monitoring"]):
 			if payload.get("print", False):  # implemented in OctoPrint version 1.4.1
 				self._taposmartplug_logger.debug(
-					"File uploaded: %s. Turning enabled plugs on." % payload.get("name", ""))
-				self._taposmartplug_logger.debug(payload)
+					"File uploaded: %s. Turning enabled plugs on.", payload.get("name", ""))
+				self._taposmartplug_logger.debug("Upload payload: %s", payload)
+				self._prewarm_sessions(lambda plug: plug["event_on_upload"] is True)
 				for plug in self._settings.get(['arrSmartplugs']):
-					self._taposmartplug_logger.debug(plug)
 					if plug["event_on_upload"] is True and not self._printer.is_ready():
-						self._taposmartplug_logger.debug("powering on %s due to %s event." % (plug["ip"], event))
+						self._taposmartplug_logger.debug("powering on %s due to %s event.", plug["ip"], event)
 						response = self.turn_on(plug["ip"])
 						if response["currentState"] == "on":
 							self._taposmartplug_logger.debug(
-								"power on successful for %s attempting connection in %s seconds" % (
-									plug["ip"], plug.get("autoConnectDelay", "0")))
+								"power on successful for %s attempting connection in %s seconds",
+								plug["ip"], plug.get("autoConnectDelay", "0"))
 							self._plugin_manager.send_plugin_message(self._identifier, response)
 							if payload.get("path", False) and payload.get("target") == "local":
 								self._autostart_file = payload.get("path")
 
 	##~~ Idle Timeout
 
-	def _start_idle_timer(self):
-		self._stop_idle_timer()
-
-		if self.powerOffWhenIdle:
-			self._idleTimer = ResettableTimer(self.idleTimeout * 60, self._idle_poweroff)
-			self._idleTimer.daemon = True
-			self._idleTimer.start()
-
-	def _stop_idle_timer(self):
-		if self._idleTimer:
-			self._idleTimer.cancel()
-			self._idleTimer = None
-
-	def _reset_idle_timer(self):
-		try:
-			if self._idleTimer.is_alive():
-				self._idleTimer.reset()
-			else:
-				raise Exception()
-		except:
-			self._start_idle_timer()
-
-	def _idle_poweroff(self):
-		if not self.powerOffWhenIdle:
-			return
-
-		if self._waitForHeaters:
-			return
-
-		if self._waitForTimelapse:
-			return
-
+	def _idle_may_power_off(self):
 		if self._printer.is_printing() or self._printer.is_paused():
-			return
+			return False
+
+		from uptime import uptime
 
 		if (uptime()/60) <= (self._settings.get_int(["idleTimeout"])):
 			self._taposmartplug_logger.debug("Just booted so wait for time sync.")
-			self._taposmartplug_logger.debug("uptime: {}, comparison: {}".format((uptime()/60), (self._settings.get_int(["idleTimeout"]))))
-			self._reset_idle_timer()
-			return
+			self._taposmartplug_logger.debug("uptime: %s, comparison: %s", uptime()/60, self._settings.get_int(["idleTimeout"]))
+			return False
 
 		self._taposmartplug_logger.debug(
-			"Idle timeout reached after %s minute(s). Turning heaters off prior to powering off plugs." % self.idleTimeout)
-		if self._wait_for_heaters():
-			self._taposmartplug_logger.debug("Heaters below temperature.")
-			if self._wait_for_timelapse():
-				self._timer_start()
-		else:
-			self._taposmartplug_logger.debug("Aborted power off due to activity.")
-
-	##~~ Timelapse Monitoring
-
-	def _wait_for_timelapse(self):
-		self._waitForTimelapse = True
-		self._taposmartplug_logger.debug("Checking timelapse status before shutting off power...")
-
-		while True:
-			if not self._waitForTimelapse:
-				return False
-
-			if not self._timelapse_active:
-				self._waitForTimelapse = False
-				return True
-
-			self._taposmartplug_logger.debug("Waiting for timelapse before shutting off power...")
-			time.sleep(5)
+			"Idle timeout reached after %s minute(s). Turning heaters off prior to powering off plugs.", self.idleTimeout)
+		return True
+
+	def _idle_transition(self, old_state, new_state, reason):
+		if new_state == COUNTDOWN:
+			self._taposmartplug_logger.debug("Starting abort power off countdown.")
+			self._prewarm_sessions(lambda plug: plug.get("automaticShutdownEnabled", False))
+		self._send_idle_state()
+
+	def _send_idle_state(self):
+		snapshot = self._idle.snapshot()
+		timeout_value = None
+		if snapshot["deadline"] is not None:
+			timeout_value = max(0, int(round(snapshot["deadline"] - snapshot["now"])))
+		self._plugin_manager.send_plugin_message(self._identifier,
+												 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
+													  state=snapshot["state"], deadline=snapshot["deadline"],
+													  now=snapshot["now"], timeout_value=timeout_value))
 
 	##~~ Temperature Cooldown
 
-	def _wait_for_heaters(self):
-		self._waitForHeaters = True
+	def _turn_off_heaters(self):
 		heaters = self._printer.get_current_temperatures()
 
 		for heater, entry in heaters.items():
@@ -682,76 +1308,40 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 				continue
 
 			if temp != 0:
-				self._taposmartplug_logger.debug("Turning off heater: %s" % heater)
-				self._skipIdleTimer = True
+				self._taposmartplug_logger.debug("Turning off heater: %s", heater)
 				self._printer.set_temperature(heater, 0)
-				self._skipIdleTimer = False
 			else:
-				self._taposmartplug_logger.debug("Heater %s already off." % heater)
-
-		while True:
-			if not self._waitForHeaters:
-				return False
-
-			heaters = self._printer.get_current_temperatures()
+				self._taposmartplug_logger.debug("Heater %s already off.", heater)
 
-			highest_temp = 0
-			heaters_above_waittemp = []
-			for heater, entry in heaters.items():
-				if not heater.startswith("tool"):
-					continue
-
-				actual = entry.get("actual")
-				if actual is None:
-					# heater doesn't exist in fw
-					continue
+	def _heaters_cooled(self):
+		heaters = self._printer.get_current_temperatures()
 
-				try:
-					temp = float(actual)
-				except ValueError:
-					# not a float for some reason, skip it
-					continue
+		heaters_above_waittemp = []
+		for heater, entry in heaters.items():
+			if not heater.startswith("tool"):
+				continue
 
-				self._taposmartplug_logger.debug("Heater %s = %sC" % (heater, temp))
-				if temp > self.idleTimeoutWaitTemp:
-					heaters_above_waittemp.append(heater)
+			actual = entry.get("actual")
+			if actual is None:
+				# heater doesn't exist in fw
+				continue
 
-				if temp > highest_temp:
-					highest_temp = temp
+			try:
+				temp = float(actual)
+			except ValueError:
+				# not a float for some reason, skip it
+				continue
 
-			if highest_temp <= self.idleTimeoutWaitTemp:
-				self._waitForHeaters = False
-				return True
+			self._taposmartplug_logger.debug("Heater %s = %sC", heater, temp)
+			if temp > self.idleTimeoutWaitTemp:
+				heaters_above_waittemp.append(heater)
 
+		if heaters_above_waittemp:
 			self._taposmartplug_logger.debug(
-				"Waiting for heaters(%s) before shutting power off..." % ', '.join(heaters_above_waittemp))
-			time.sleep(5)
-
-	##~~ Abort Power Off Timer
-
-	def _timer_start(self):
-		if self._abort_timer is not None:
-			return
-
-		self._taposmartplug_logger.debug("Starting abort power off timer.")
-
-		self._timeout_value = self.abortTimeout
-		self._abort_timer = RepeatedTimer(1, self._timer_task)
-		self._abort_timer.start()
-
-	def _timer_task(self):
-		if self._timeout_value is None:
-			return
-
-		self._timeout_value -= 1
-		self._plugin_manager.send_plugin_message(self._identifier,
-												 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-													  timeout_value=self._timeout_value))
-		if self._timeout_value <= 0:
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._shutdown_system()
+				"Waiting for heaters(%s) before shutting power off...", ', '.join(heaters_above_waittemp))
+			return False
+		self._taposmartplug_logger.debug("Heaters below temperature.")
+		return True
 
 	def _shutdown_system(self):
 		self._taposmartplug_logger.debug("Automatically powering off enabled plugs.")
@@ -778,7 +1368,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			if response:
 				self._settings.set([plugip], response)
 				self._settings.save()
-		self._taposmartplug_logger.debug("get_device_id response: %s" % response)
+		self._taposmartplug_logger.debug("get_device_id response: %s", response)
 		return response
 
 	def deep_get(self, d, keys, default=None):
@@ -825,6 +1415,9 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		return result.decode('latin-1')
 
 	def sendCommand(self, cmd, plugip, plug_num=-1):
+		import re
+		import socket
+
 		commands = {'info': '{"system":{"get_sysinfo":{}}}',
 					'on': '{"system":{"set_relay_state":{"state":1}}}',
 					'off': '{"system":{"set_relay_state":{"state":0}}}',
@@ -843,15 +1436,15 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		try:
 			socket.inet_aton(plugip)
 			ip = plugip
-			self._taposmartplug_logger.debug("IP %s is valid." % plugip)
+			self._taposmartplug_logger.debug("IP %s is valid.", plugip)
 		except socket.error:
 			# try to convert hostname to ip
-			self._taposmartplug_logger.debug("Invalid ip %s trying hostname." % plugip)
+			self._taposmartplug_logger.debug("Invalid ip %s trying hostname.", plugip)
 			try:
 				ip = socket.gethostbyname(plugip)
-				self._taposmartplug_logger.debug("Hostname %s is valid." % plugip)
+				self._taposmartplug_logger.debug("Hostname %s is valid.", plugip)
 			except (socket.herror, socket.gaierror):
-				self._taposmartplug_logger.debug("Invalid hostname %s." % plugip)
+				self._taposmartplug_logger.debug("Invalid hostname %s.", plugip)
 				return {"system": {"get_sysinfo": {"relay_state": 3}}, "emeter": {"err_code": True}}
 
 		if int(plug_num) >= 0:
@@ -859,7 +1452,7 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			cmd["context"] = dict(child_ids=[self._get_device_id(plug_ip_num)])
 
 		try:
-			self._taposmartplug_logger.debug("Sending command %s to %s" % (cmd, plugip))
+			self._taposmartplug_logger.debug("Sending command %s to %s", cmd, plugip)
 			sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			sock_tcp.connect((ip, 9999))
 			sock_tcp.send(self.encrypt(json.dumps(cmd)))
@@ -869,17 +1462,17 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 				data = data + sock_tcp.recv(1024)
 			sock_tcp.close()
 
-			self._taposmartplug_logger.debug(self.decrypt(data))
+			self._taposmartplug_logger.debug("Received %s bytes from %s.", len(data), plugip)
 			return json.loads(self.decrypt(data[4:]))
 		except socket.error:
-			self._taposmartplug_logger.debug("Could not connect to %s." % plugip)
+			self._taposmartplug_logger.debug("Could not connect to %s.", plugip)
 			return {"system": {"get_sysinfo": {"relay_state": 3}}, "emeter": {"err_code": True}}
 
 	##~~ Gcode processing hook
 
 	def gcode_turn_off(self, plug):
 		if plug["warnPrinting"] and self._printer.is_printing():
-			self._taposmartplug_logger.debug("Not powering off %s because printer is printing." % plug["label"])
+			self._taposmartplug_logger.debug("Not powering off %s because printer is printing.", plug["label"])
 		else:
 			chk = self.turn_off(plug["ip"])
 			self._plugin_manager.send_plugin_message(self._identifier, chk)
@@ -888,19 +1481,27 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		chk = self.turn_on(plug["ip"])
 		self._plugin_manager.send_plugin_message(self._identifier, chk)
 
+	def _is_heater_off(self, gcode, cmd):
+		# the idle shutdown turns tools, bed and chamber off itself, that must not count as activity
+		if gcode not in ["M104", "M140", "M141"]:
+			return False
+		import re
+		return re.search(r"\bS0*(\.0*)?(\s|$)", cmd) is not None
+
 	def processGCODE(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-		if self.powerOffWhenIdle and not (gcode in self._idleIgnoreCommandsArray):
-			self._waitForHeaters = False
-			self._reset_idle_timer()
+		if self.powerOffWhenIdle and not (gcode in self._idleIgnoreCommandsArray) and not self._is_heater_off(gcode, cmd):
+			self._idle.activity("gcode")
 
 		if gcode not in ["M80", "M81"]:
 			return
 
+		import re
+
 		if gcode == "M80":
 			plugip = re.sub(r'^M80\s?', '', cmd)
-			self._taposmartplug_logger.debug("Received M80 command, attempting power on of %s." % plugip)
+			self._taposmartplug_logger.debug("Received M80 command, attempting power on of %s.", plugip)
 			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-			self._taposmartplug_logger.debug(plug)
+			self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 			if plug and plug["gcodeEnabled"]:
 				t = threading.Timer(int(plug["gcodeOnDelay"]), self.gcode_turn_on, [plug])
 				t.daemon = True
@@ -908,9 +1509,9 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			return
 		if gcode == "M81":
 			plugip = re.sub(r'^M81\s?', '', cmd)
-			self._taposmartplug_logger.debug("Received M81 command, attempting power off of %s." % plugip)
+			self._taposmartplug_logger.debug("Received M81 command, attempting power off of %s.", plugip)
 			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-			self._taposmartplug_logger.debug(plug)
+			self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 			if plug and plug["gcodeEnabled"]:
 				t = threading.Timer(int(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug])
 				t.daemon = True
@@ -918,13 +1519,11 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			return
 
 	def processAtCommand(self, comm_instance, phase, command, parameters, tags=None, *args, **kwargs):
-		self._logger.info(command)
-		self._logger.info(parameters)
 		if command == "TAPOON":
 			plugip = parameters
-			self._taposmartplug_logger.debug("Received @TAPOON command, attempting power on of %s." % plugip)
+			self._taposmartplug_logger.debug("Received @TAPOON command, attempting power on of %s.", plugip)
 			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-			self._taposmartplug_logger.debug(plug)
+			self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 			if plug and plug["gcodeEnabled"]:
 				t = threading.Timer(int(plug["gcodeOnDelay"]), self.gcode_turn_on, [plug])
 				t.daemon = True
@@ -932,9 +1531,9 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			return None
 		if command == "TAPOOFF":
 			plugip = parameters
-			self._taposmartplug_logger.debug("Received TAPOOFF command, attempting power off of %s." % plugip)
+			self._taposmartplug_logger.debug("Received TAPOOFF command, attempting power off of %s.", plugip)
 			plug = self.plug_search(self._settings.get(["arrSmartplugs"]), "ip", plugip)
-			self._taposmartplug_logger.debug(plug)
+			self._taposmartplug_logger.debug("Plug: %s", PlugSummary(plug))
 			if plug and plug["gcodeEnabled"]:
 				t = threading.Timer(int(plug["gcodeOffDelay"]), self.gcode_turn_off, [plug])
 				t.daemon = True
@@ -942,41 +1541,47 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 			return None
 		if command == 'TAPOIDLEON':
 			self.powerOffWhenIdle = True
-			self._reset_idle_timer()
+			self._idle.enable("@TAPOIDLEON")
 		if command == 'TAPOIDLEOFF':
 			self.powerOffWhenIdle = False
-			self._stop_idle_timer()
-			if self._abort_timer is not None:
-				self._abort_timer.cancel()
-				self._abort_timer = None
-			self._timeout_value = None
+			self._idle.disable("@TAPOIDLEOFF")
 		if command in ["TAPOIDLEON", "TAPOIDLEOFF"]:
-			self._plugin_manager.send_plugin_message(self._identifier,
-													 dict(powerOffWhenIdle=self.powerOffWhenIdle, type="timeout",
-														  timeout_value=self._timeout_value))
+			self._send_idle_state()
 
 	##~~ Temperatures received hook
 
-	def check_temps(self, parsed_temps):
-		thermal_runaway_triggered = False
-		for k, v in parsed_temps.items():
-			if k == "B" and v[0] > int(self._settings.get(["thermal_runaway_max_bed"])):
-				self._taposmartplug_logger.debug("Max bed temp reached, shutting off plugs.")
-				thermal_runaway_triggered = True
-			if k.startswith("T") and v[0] > int(self._settings.get(["thermal_runaway_max_extruder"])):
-				self._taposmartplug_logger.debug("Extruder max temp reached, shutting off plugs.")
-				thermal_runaway_triggered = True
-			if thermal_runaway_triggered == True:
-				for plug in self._settings.get(['arrSmartplugs']):
-					if plug["thermal_runaway"] == True:
-						response = self.turn_off(plug["ip"])
-						if response["currentState"] == "off":
-							self._plugin_manager.send_plugin_message(self._identifier, response)
+	def _build_thermal_monitor(self):
+		if not self._settings.get_boolean(["thermal_runaway_monitoring"]):
+			return None
+		return ThermalMonitor(int(self._settings.get(["thermal_runaway_max_bed"])),
+							  int(self._settings.get(["thermal_runaway_max_extruder"])),
+							  self._settings.get_int(["thermal_runaway_window"]),
+							  float(self._settings.get(["thermal_runaway_max_rise"])),
+							  float(self._settings.get(["thermal_runaway_max_deviation"])),
+							  self._settings.get_int(["thermal_runaway_prewarm_margin"]))
+
+	def check_temps(self, trips):
+		try:
+			for heater, reason in trips:
+				self._taposmartplug_logger.info("Thermal runaway on %s: %s, shutting off plugs.", heater, reason)
+			for plug in self._settings.get(['arrSmartplugs']):
+				if plug["thermal_runaway"] == True:
+					response = self.turn_off(plug["ip"])
+					if response["currentState"] == "off":
+						self._plugin_manager.send_plugin_message(self._identifier, response)
+		finally:
+			self._thermal_shutdown_mutex.release()
 
 	def monitor_temperatures(self, comm, parsed_temps):
-		if self._settings.get(["thermal_runaway_monitoring"]):
-			# Run inside it's own thread to prevent communication blocking
-			t = threading.Timer(0, self.check_temps, [parsed_temps])
+		thermal = self._thermal
+		if thermal is None:
+			return parsed_temps
+		trips = thermal.update(parsed_temps)
+		if thermal.near_limit:
+			self._prewarm_sessions(lambda plug: plug["thermal_runaway"] is True)
+		# only start a power off if none is running yet, the comm thread must never wait for one
+		if trips and self._thermal_shutdown_mutex.acquire(False):
+			t = threading.Thread(target=self.check_temps, args=[trips])
 			t.daemon = True
 			t.start()
 		return parsed_temps
@@ -1019,8 +1624,12 @@ class taposmartplugPlugin(octoprint.plugin.SettingsPlugin,
 		)
 
 
+def _import_duration_ms():
+	return round((_import_finished - _import_started) * 1000, 1)
+
+
 __plugin_name__ = "Tapo Smartplug"
-__plugin_pythoncompat__ = ">=2.7,<4"
+__plugin_pythoncompat__ = ">=3,<4"
 
 
 def __plugin_load__():
@@ -1033,5 +1642,9 @@ def __plugin_load__():
 		"octoprint.comm.protocol.atcommand.sending": __plugin_implementation__.processAtCommand,
 		"octoprint.comm.protocol.temperatures.received": __plugin_implementation__.monitor_temperatures,
 		"octoprint.access.permissions": __plugin_implementation__.get_additional_permissions,
+		"octoprint.server.http.routes": __plugin_implementation__.route_hook,
 		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
 	}
+
+
+_import_finished = time.time()
@@ -0,0 +1,111 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+class CircuitBreaker(object):
+	"""
+	Tracks reachability of a single device.
+
+	closed:    calls go through, consecutive failures are counted.
+	open:      calls fail fast until reset_timeout has elapsed.
+	half_open: exactly one probe call is let through, its outcome decides
+	           whether the breaker closes again or re-opens.
+
+	With a probe callable, the probe is not left to whichever caller comes next: it runs on a timer
+	thread reset_timeout after the breaker opened, and callers fail fast until it has closed the
+	breaker again. probe returns True if the device answered.
+	"""
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half_open"
+
+	def __init__(self, failure_threshold=2, reset_timeout=60, on_change=None, probe=None):
+		self.failure_threshold = max(1, int(failure_threshold))
+		self.reset_timeout = max(1, int(reset_timeout))
+		self.on_change = on_change
+		self.probe = probe
+		self._mutex = threading.Lock()
+		self._state = self.CLOSED
+		self._failures = 0
+		self._opened_at = 0
+		self._probe_in_flight = False
+
+	@property
+	def state(self):
+		with self._mutex:
+			return self._state
+
+	def available(self):
+		"""Like allow() but without claiming the half-open probe slot."""
+		with self._mutex:
+			if self.probe is not None:
+				return self._state == self.CLOSED
+			if self._state == self.OPEN:
+				return time.time() - self._opened_at >= self.reset_timeout
+			return not (self._state == self.HALF_OPEN and self._probe_in_flight)
+
+	def allow(self):
+		"""Returns True if the caller may talk to the device."""
+		with self._mutex:
+			if self._state == self.CLOSED:
+				return True
+			if self.probe is not None:
+				return False
+			if self._state == self.OPEN:
+				if time.time() - self._opened_at < self.reset_timeout:
+					return False
+				self._set_state(self.HALF_OPEN)
+			if self._probe_in_flight:
+				return False
+			self._probe_in_flight = True
+			return True
+
+	def record_success(self):
+		with self._mutex:
+			self._failures = 0
+			self._probe_in_flight = False
+			if self._state != self.CLOSED:
+				self._set_state(self.CLOSED)
+
+	def record_failure(self):
+		with self._mutex:
+			self._failures += 1
+			self._probe_in_flight = False
+			if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+				self._opened_at = time.time()
+				if self._state != self.OPEN:
+					self._set_state(self.OPEN)
+					self._schedule_probe()
+
+	def _schedule_probe(self):
+		"""Must be called with the mutex held."""
+		if self.probe is None:
+			return
+		t = threading.Timer(self.reset_timeout, self._run_probe)
+		t.daemon = True
+		t.start()
+
+	def _run_probe(self):
+		with self._mutex:
+			if self._state != self.OPEN:
+				return
+			self._set_state(self.HALF_OPEN)
+			self._probe_in_flight = True
+		try:
+			reachable = self.probe()
+		except Exception:
+			reachable = False
+		if reachable:
+			self.record_success()
+		else:
+			self.record_failure()
+
+	def _set_state(self, state):
+		old_state = self._state
+		self._state = state
+		if callable(self.on_change):
+			self.on_change(old_state, state)
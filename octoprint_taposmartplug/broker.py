@@ -0,0 +1,569 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from .breaker import CircuitBreaker
+from .sessions import (SessionPool, get_child_device_list, get_device_info, outlet_index, outlet_info, plug_host,
+					   set_device_on, tapo_request)
+
+# Several OctoPrint instances on one host (one per printer) usually share plugs. Instead of every instance
+# logging in to and polling the same devices, they can talk to one broker process over a Unix socket. The
+# broker owns the sessions, serializes requests per device and polls each watched plug once for everybody.
+#
+# The protocol is one JSON object per line. Requests carry an id and get exactly one response with that id
+# and either "result" or "error"; requests without an id are fire and forget. The broker pushes
+# dict(event="state", ip=..., result=...) to every connection watching a plug whenever it read the plug's
+# device info.
+
+
+def default_socket_path():
+	return os.path.join(tempfile.gettempdir(), "octoprint-taposmartplug-%s.sock" % getattr(os, "getuid", lambda: 0)())
+
+
+def credentials(plug):
+	"""The part of a plug's settings the broker needs."""
+	return dict(ip=plug["ip"], username=plug.get("username"), password=plug.get("password"))
+
+
+class BrokerUnavailable(Exception):
+	pass
+
+
+class BrokerError(Exception):
+	pass
+
+
+class _Connection(object):
+
+	def __init__(self, sock):
+		self.sock = sock
+		self._mutex = threading.Lock()
+
+	def send(self, message):
+		data = (json.dumps(message) + "\n").encode("utf-8")
+		try:
+			with self._mutex:
+				self.sock.sendall(data)
+		except socket.error:
+			pass
+
+
+class PlugBroker(object):
+	"""
+	The broker side. One instance per socket path is enforced with a lock file, a second broker started
+	by a racing client exits right away. The broker exits on its own once no client was connected for
+	idle_exit seconds.
+	"""
+
+	def __init__(self, socket_path, logger, session_ttl=300, failure_threshold=2, reset_timeout=60, idle_exit=60):
+		self.socket_path = socket_path
+		self._logger = logger
+		self.failure_threshold = failure_threshold
+		self.reset_timeout = reset_timeout
+		self.idle_exit = idle_exit
+		self._sessions = SessionPool(logger, session_ttl)
+		self._breakers = {}
+		self._host_locks = {}
+		self._status = {}
+		self._watches = {}
+		self._clients = set()
+		self._mutex = threading.Lock()
+		self._poll_condition = threading.Condition(self._mutex)
+		self._running = True
+
+	##~~ Device access
+
+	def _host_lock(self, plug):
+		with self._mutex:
+			return self._host_locks.setdefault(plug_host(plug["ip"]), threading.RLock())
+
+	def _get_breaker(self, plug):
+		with self._mutex:
+			host = plug_host(plug["ip"])
+			if host not in self._breakers:
+				self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+			return self._breakers[host]
+
+	def call(self, plug, action):
+		"""Runs action on a session to plug. Requests to the same device never overlap."""
+		breaker = self._get_breaker(plug)
+		if not breaker.allow():
+			raise BrokerError("Circuit breaker for %s is open" % plug_host(plug["ip"]))
+		with self._host_lock(plug):
+			try:
+				p100, cached = self._sessions.get(plug)
+				try:
+					result = action(p100)
+				except Exception:
+					if not cached:
+						raise
+					self._sessions.invalidate(plug)
+					p100, cached = self._sessions.get(plug)
+					result = action(p100)
+			except Exception:
+				self._sessions.invalidate(plug)
+				breaker.record_failure()
+				raise
+		breaker.record_success()
+		return result
+
+	@staticmethod
+	def _status_key(plug):
+		# all outlets of a strip share one child device list
+		if outlet_index(plug["ip"]) is not None:
+			return plug_host(plug["ip"]) + "/*"
+		return plug["ip"]
+
+	def status(self, plug, max_age=0):
+		"""Device info of plug, read from the device unless a result younger than max_age seconds is cached."""
+		key = self._status_key(plug)
+		with self._host_lock(plug):
+			with self._mutex:
+				cached = self._status.get(key)
+			if cached is not None and time.time() - cached[0] <= max_age:
+				info = cached[1]
+			else:
+				if key == plug["ip"]:
+					info = self.call(plug, lambda p100: get_device_info(p100, self._logger))
+				else:
+					info = self.call(plug, get_child_device_list)
+				with self._mutex:
+					self._status[key] = (time.time(), info)
+				self._publish(key, info)
+		return info if key == plug["ip"] else outlet_info(info, plug["ip"])
+
+	def switch(self, plug, on):
+		self.call(plug, lambda p100: set_device_on(p100, plug["ip"], on))
+		with self._mutex:
+			self._status.pop(self._status_key(plug), None)
+		return True
+
+	##~~ Subscriptions
+
+	def watch(self, connection, plugs, interval):
+		with self._poll_condition:
+			if plugs:
+				self._watches[connection] = (max(int(interval), 1), [credentials(plug) for plug in plugs])
+			else:
+				self._watches.pop(connection, None)
+			self._poll_condition.notify()
+
+	def _publish(self, key, info):
+		with self._mutex:
+			watches = [(connection, plug) for connection, (interval, plugs) in self._watches.items()
+					   for plug in plugs if self._status_key(plug) == key]
+		for connection, plug in watches:
+			try:
+				result = info if key == plug["ip"] else outlet_info(info, plug["ip"])
+			except Exception as e:
+				self._logger.debug("Could not publish state of %s: %s", plug["ip"], e)
+				continue
+			connection.send(dict(event="state", ip=plug["ip"], result=result))
+
+	def _poll(self):
+		next_poll = {}
+		while True:
+			with self._poll_condition:
+				if not self._running:
+					return
+				schedule = {}
+				for interval, plugs in self._watches.values():
+					for plug in plugs:
+						if plug["ip"] not in schedule or interval < schedule[plug["ip"]][1]:
+							schedule[plug["ip"]] = (plug, interval)
+
+			now = time.time()
+			for ip in [ip for ip in next_poll if ip not in schedule]:
+				del next_poll[ip]
+			for ip, (plug, interval) in schedule.items():
+				if next_poll.get(ip, 0) <= now:
+					next_poll[ip] = now + interval
+					t = threading.Thread(target=self._poll_plug, args=[plug, interval])
+					t.daemon = True
+					t.start()
+
+			with self._poll_condition:
+				if self._running:
+					self._poll_condition.wait(min(next_poll.values()) - time.time() if next_poll else None)
+
+	def _poll_plug(self, plug, interval):
+		try:
+			# anything read by a client since the last poll is recent enough
+			self.status(plug, max_age=interval / 2.0)
+		except Exception as e:
+			self._logger.debug("Polling %s failed: %s", plug_host(plug["ip"]), e)
+
+	##~~ Server
+
+	DEVICE_OPS = ["status", "on", "off", "request"]
+
+	def _dispatch(self, connection, message):
+		op = message.get("op")
+		try:
+			if op == "status":
+				result = self.status(message["plug"], float(message.get("max_age", 0)))
+			elif op in ["on", "off"]:
+				result = self.switch(message["plug"], op == "on")
+			elif op == "request":
+				result = self.call(message["plug"],
+								   lambda p100: tapo_request(p100, message["method"], message.get("params")))
+			elif op == "warm":
+				self._sessions.warm(message["plug"])
+				result = True
+			elif op == "watch":
+				self.watch(connection, message.get("plugs", []), message.get("interval", 60))
+				result = True
+			else:
+				raise BrokerError("Unknown op %s" % op)
+			response = dict(id=message.get("id"), result=result)
+		except Exception as e:
+			response = dict(id=message.get("id"), error=str(e))
+		if message.get("id") is not None:
+			connection.send(response)
+
+	def _handle(self, sock):
+		connection = _Connection(sock)
+		try:
+			for line in sock.makefile("rb"):
+				try:
+					message = json.loads(line.decode("utf-8"))
+				except ValueError:
+					continue
+				if message.get("op") in self.DEVICE_OPS:
+					# device requests can take seconds, they must not hold up other requests of this client
+					t = threading.Thread(target=self._dispatch, args=[connection, message])
+					t.daemon = True
+					t.start()
+				else:
+					# watch and warm return at once, handling them in order keeps the last watch the one in effect
+					self._dispatch(connection, message)
+		except socket.error:
+			pass
+		finally:
+			self.watch(connection, [], 0)
+			with self._mutex:
+				self._clients.discard(sock)
+			sock.close()
+
+	def _acquire_lock(self):
+		import fcntl
+
+		lock_file = open(self.socket_path + ".lock", "a")
+		try:
+			fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			lock_file.close()
+			return None
+		return lock_file
+
+	def serve_forever(self):
+		lock_file = self._acquire_lock()
+		if lock_file is None:
+			self._logger.info("Another broker is already serving %s.", self.socket_path)
+			return
+
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# plug credentials pass through this socket, only our own user may connect
+		umask = os.umask(0o177)
+		try:
+			server.bind(self.socket_path)
+		finally:
+			os.umask(umask)
+		server.listen(16)
+		server.settimeout(1)
+		self._logger.info("Broker listening on %s.", self.socket_path)
+
+		poller = threading.Thread(target=self._poll)
+		poller.daemon = True
+		poller.start()
+
+		last_client = time.time()
+		try:
+			while True:
+				try:
+					sock, _ = server.accept()
+				except socket.timeout:
+					with self._mutex:
+						if self._clients:
+							last_client = time.time()
+						elif time.time() - last_client > self.idle_exit:
+							break
+					continue
+				sock.settimeout(None)
+				with self._mutex:
+					self._clients.add(sock)
+				t = threading.Thread(target=self._handle, args=[sock])
+				t.daemon = True
+				t.start()
+		finally:
+			self._logger.info("No clients left, broker exiting.")
+			with self._poll_condition:
+				self._running = False
+				self._poll_condition.notify()
+			server.close()
+			os.unlink(self.socket_path)
+			lock_file.close()
+
+
+class BrokerClient(object):
+	"""
+	The plugin side of the broker connection. Connects lazily and starts the broker if nobody is
+	listening yet. Raises BrokerUnavailable if the broker can not be reached, so callers can fall back
+	to talking to the devices themselves, and BrokerError for failures the broker reported.
+	"""
+
+	def __init__(self, socket_path, logger, on_event=None, timeout=15, spawn_args=None):
+		self.socket_path = socket_path
+		self.timeout = timeout
+		self._logger = logger
+		self._on_event = on_event
+		self._spawn_args = spawn_args
+		self._sock = None
+		self._watch = None
+		self._next_id = 0
+		self._pending = {}
+		self._mutex = threading.Lock()
+		self._connect_mutex = threading.Lock()
+		self._send_mutex = threading.Lock()
+		self._connecting = False
+		self._closed = False
+
+	def _spawn(self):
+		import subprocess
+
+		self._logger.info("Starting plug broker on %s.", self.socket_path)
+		devnull = open(os.devnull, "r+b")
+		try:
+			subprocess.Popen([sys.executable, "-m", "octoprint_taposmartplug.broker", "--socket", self.socket_path]
+							 + list(self._spawn_args or []),
+							 stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+		finally:
+			devnull.close()
+
+	def _try_connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self.socket_path)
+		except socket.error:
+			sock.close()
+			return None
+		return sock
+
+	def _connect(self):
+		with self._connect_mutex:
+			if self._sock is not None:
+				return
+			if self._closed:
+				raise BrokerUnavailable("Client closed")
+			sock = self._try_connect()
+			if sock is None and self._spawn_args is not None:
+				self._spawn()
+				deadline = time.time() + 5
+				while sock is None and time.time() < deadline:
+					time.sleep(0.1)
+					sock = self._try_connect()
+			if sock is None:
+				raise BrokerUnavailable("Nothing is listening on %s" % self.socket_path)
+
+			self._sock = sock
+			reader = threading.Thread(target=self._read, args=[sock])
+			reader.daemon = True
+			reader.start()
+			watch = self._watch
+			if watch is not None:
+				self._send(dict(op="watch", plugs=watch[0], interval=watch[1]))
+
+	def _send(self, message):
+		sock = self._sock
+		if sock is None:
+			raise BrokerUnavailable("Not connected")
+		try:
+			with self._send_mutex:
+				sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+		except socket.error as e:
+			self._disconnected(sock)
+			raise BrokerUnavailable(str(e))
+
+	def _read(self, sock):
+		try:
+			for line in sock.makefile("rb"):
+				try:
+					message = json.loads(line.decode("utf-8"))
+				except ValueError:
+					continue
+				if "event" in message:
+					if callable(self._on_event):
+						try:
+							self._on_event(message)
+						except Exception:
+							self._logger.exception("Handling broker event %s failed.", message.get("event"))
+					continue
+				with self._mutex:
+					pending = self._pending.get(message.get("id"))
+				if pending is not None:
+					pending[1] = message
+					pending[0].set()
+		except socket.error:
+			pass
+		self._disconnected(sock)
+
+	def _disconnected(self, sock):
+		with self._mutex:
+			if self._sock is not sock:
+				return
+			self._sock = None
+			pending = list(self._pending.values())
+		sock.close()
+		for entry in pending:
+			entry[1] = dict(unavailable="Connection to the broker was lost")
+			entry[0].set()
+		if self._watch is not None and not self._closed:
+			# the broker went away, start a new one so watched plugs keep being polled
+			t = threading.Timer(1, self._reconnect)
+			t.daemon = True
+			t.start()
+
+	def _reconnect(self):
+		try:
+			self._connect()
+		except BrokerUnavailable as e:
+			self._logger.info("Could not reconnect to the plug broker: %s", e)
+			watch = self._watch
+			if watch is not None and callable(watch[2]) and not self._closed:
+				watch[2]()
+		finally:
+			with self._mutex:
+				self._connecting = False
+
+	def _connect_in_background(self):
+		with self._mutex:
+			if self._connecting or self._closed:
+				return
+			self._connecting = True
+		t = threading.Thread(target=self._reconnect)
+		t.daemon = True
+		t.start()
+
+	def call(self, op, **kwargs):
+		self._connect()
+		with self._mutex:
+			self._next_id += 1
+			request_id = self._next_id
+			entry = self._pending[request_id] = [threading.Event(), None]
+		try:
+			self._send(dict(kwargs, op=op, id=request_id))
+			if not entry[0].wait(self.timeout):
+				raise BrokerError("%s timed out" % op)
+		finally:
+			with self._mutex:
+				self._pending.pop(request_id, None)
+
+		response = entry[1]
+		if "unavailable" in response:
+			raise BrokerUnavailable(response["unavailable"])
+		if "error" in response:
+			raise BrokerError(response["error"])
+		return response.get("result")
+
+	def notify(self, op, **kwargs):
+		"""
+		Sends a request without waiting for the result. Never waits for a connection either, it is called
+		from the comm thread: if the broker is not connected yet, connecting (and starting it) happens in
+		the background and the message is dropped. Returns False if the message was not sent.
+		"""
+		if self._sock is None:
+			self._connect_in_background()
+			self._logger.debug("Not connected to the plug broker yet, dropping %s.", op)
+			return False
+		try:
+			self._send(dict(kwargs, op=op))
+			return True
+		except BrokerUnavailable as e:
+			self._logger.debug("Could not send %s to the plug broker: %s", op, e)
+			return False
+
+	def watch(self, plugs, interval, on_unavailable=None):
+		"""
+		Asks the broker to poll plugs every interval seconds and push their state. Replaces earlier watches.
+		Like notify() this never waits for a connection, if the broker is not connected yet the watch is sent
+		once the background connect succeeds. on_unavailable is called from that thread if it fails, or if
+		the broker goes away later and can not be restarted.
+		"""
+		plugs = [credentials(plug) for plug in plugs]
+		self._watch = (plugs, interval, on_unavailable) if plugs else None
+		if self._sock is None:
+			if plugs:
+				self._connect_in_background()
+			return
+		try:
+			self._send(dict(op="watch", plugs=plugs, interval=interval))
+		except BrokerUnavailable as e:
+			# _disconnected() reconnects and sends the watch again
+			self._logger.debug("Could not send watch to the plug broker: %s", e)
+
+	def close(self):
+		self._closed = True
+		self._watch = None
+		sock = self._sock
+		if sock is not None:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			self._disconnected(sock)
+
+
+class BrokerSession(object):
+	"""Stands in for a logged in PyP100 session, every request is forwarded to the broker."""
+
+	brokered = True
+
+	def __init__(self, client, plug, max_age=2):
+		self._client = client
+		self._plug = credentials(plug)
+		self.max_age = max_age
+		self.ipAddress = plug_host(plug["ip"])
+
+	def turnOn(self):
+		return self._client.call("on", plug=self._plug)
+
+	def turnOff(self):
+		return self._client.call("off", plug=self._plug)
+
+	def getDeviceInfo(self):
+		return self._client.call("status", plug=self._plug, max_age=self.max_age)
+
+	def request(self, method, params=None):
+		return self._client.call("request", plug=self._plug, method=method, params=params)
+
+
+def main(argv=None):
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Shares Tapo plug sessions between OctoPrint instances.")
+	parser.add_argument("--socket", default=default_socket_path())
+	parser.add_argument("--session-ttl", type=int, default=300)
+	parser.add_argument("--failure-threshold", type=int, default=2)
+	parser.add_argument("--reset-timeout", type=int, default=60)
+	parser.add_argument("--idle-exit", type=int, default=60)
+	parser.add_argument("--log-file")
+	args = parser.parse_args(argv)
+
+	logging.basicConfig(filename=args.log_file, level=logging.INFO,
+						format="[%(asctime)s] %(levelname)s: %(message)s")
+	PlugBroker(args.socket, logging.getLogger("octoprint.plugins.taposmartplug.broker"), args.session_ttl,
+			   args.failure_threshold, args.reset_timeout, args.idle_exit).serve_forever()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,246 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import binascii
+import json
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+TAPO_DISCOVERY_PORT = 20002
+LEGACY_PORT = 9999
+ENERGY_MONITORING_MODELS = ["P110", "P115", "KP115", "KP125", "HS110", "HS300"]
+
+_rsa_key = None
+_rsa_key_mutex = threading.Lock()
+
+
+def legacy_encrypt(string, length_prefix=True):
+	key = 171
+	result = struct.pack(">I", len(string)) if length_prefix else b""
+	for i in bytearray(string.encode("latin-1")):
+		a = key ^ i
+		key = a
+		result += struct.pack("B", a)
+	return result
+
+
+def legacy_decrypt(data):
+	key = 171
+	result = bytearray()
+	for i in bytearray(data):
+		result.append(key ^ i)
+		key = i
+	return result.decode("latin-1")
+
+
+def _tapo_public_key():
+	"""The Tapo probe carries an RSA public key. It is only generated once and only if pycryptodome is around."""
+	global _rsa_key
+	with _rsa_key_mutex:
+		if _rsa_key is None:
+			from Crypto.PublicKey import RSA
+
+			_rsa_key = RSA.generate(1024).publickey().export_key("PEM").decode("ascii")
+		return _rsa_key
+
+
+def tapo_probe():
+	payload = json.dumps({"params": {"rsa_key": _tapo_public_key()}}).encode("utf-8")
+	header = struct.pack(">BBHHBBII", 2, 0, 1, len(payload), 17, 0, random.randint(0, 2 ** 31 - 1), 0x5A6B7C8D)
+	query = bytearray(header + payload)
+	query[12:16] = struct.pack(">I", binascii.crc32(bytes(query)) & 0xFFFFFFFF)
+	return bytes(query)
+
+
+def _has_energy_monitoring(model):
+	return any((model or "").startswith(energy_model) for energy_model in ENERGY_MONITORING_MODELS)
+
+
+def parse_tapo_response(ip, data):
+	result = json.loads(data[16:].decode("utf-8")).get("result", {})
+	model = result.get("device_model", "")
+	return dict(ip=result.get("ip", ip), protocol="tapo", model=model, mac=result.get("mac"), alias=None,
+				device_type=result.get("device_type"), emeter=_has_energy_monitoring(model), children=[])
+
+
+def parse_legacy_response(ip, sysinfo):
+	sysinfo = sysinfo.get("system", {}).get("get_sysinfo", {})
+	model = sysinfo.get("model", "")
+	children = [dict(index=index, id=child.get("id"), alias=child.get("alias"), state=child.get("state"))
+				for index, child in enumerate(sysinfo.get("children", []))]
+	return dict(ip=ip, protocol="legacy", model=model, mac=sysinfo.get("mac", sysinfo.get("mic_mac")),
+				alias=sysinfo.get("alias"), device_type=sysinfo.get("type", sysinfo.get("mic_type")),
+				emeter="ENE" in sysinfo.get("feature", "") or _has_energy_monitoring(model), children=children)
+
+
+def parse_network(cidr, max_addresses=1024):
+	"""
+	Returns the ip_network for cidr. Raises ValueError if it is not a valid IPv4 network or is wider than
+	max_addresses (a /22 by default), sweeping more than that would tie up a thread for minutes.
+	"""
+	import ipaddress
+
+	network = ipaddress.ip_network(u"%s" % cidr, strict=False)
+	if network.version != 4:
+		raise ValueError("Only IPv4 networks can be swept: %s" % cidr)
+	if network.num_addresses > max_addresses:
+		raise ValueError("%s is too large to sweep, use a /%s or smaller" % (cidr, 32 - (max_addresses.bit_length() - 1)))
+	return network
+
+
+class PlugDiscovery(object):
+	"""
+	Finds Tapo and legacy Kasa plugs on the local network. Broadcast probes for both protocols go out on
+	one pass and replies are collected until timeout; optionally every host of a CIDR range is swept over
+	TCP with a bounded number of concurrent connects, which also finds devices that ignore broadcasts.
+	"""
+
+	def __init__(self, logger, timeout=2.0, connect_timeout=0.5, max_workers=128):
+		self._logger = logger
+		self.timeout = timeout
+		self.connect_timeout = connect_timeout
+		self.max_workers = max_workers
+
+	def discover(self, cidr=None):
+		results = {}
+		targets = ["255.255.255.255"]
+		network = None
+		if cidr:
+			network = parse_network(cidr)
+			targets.append(str(network.broadcast_address))
+
+		# broadcast replies are collected while the sweep runs, dict.setdefault keeps whichever came first
+		broadcast = threading.Thread(target=self._probe, args=[targets, results])
+		broadcast.daemon = True
+		broadcast.start()
+		candidates = self._sweep(network, results) if network is not None else []
+		broadcast.join()
+		self._probe_candidates([ip for ip in candidates if ip not in results], results)
+		return sorted(results.values(), key=lambda device: socket.inet_aton(device["ip"]))
+
+	def _probe(self, targets, results):
+		sockets = []
+		probes = [(TAPO_DISCOVERY_PORT, self._safe_tapo_probe()),
+				  (LEGACY_PORT, legacy_encrypt(json.dumps({"system": {"get_sysinfo": {}}}), length_prefix=False))]
+		for port, probe in probes:
+			if probe is None:
+				continue
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+			for target in targets:
+				try:
+					sock.sendto(probe, (target, port))
+				except socket.error as e:
+					self._logger.debug("Could not send discovery probe to %s:%s: %s", target, port, e)
+			sockets.append((sock, port))
+
+		try:
+			self._collect(sockets, results, self.timeout)
+		finally:
+			for sock, port in sockets:
+				sock.close()
+
+	def _safe_tapo_probe(self):
+		try:
+			return tapo_probe()
+		except Exception as e:
+			self._logger.debug("Tapo discovery is not available: %s", e)
+			return None
+
+	def _collect(self, sockets, results, timeout):
+		by_fileno = dict((sock.fileno(), (sock, port)) for sock, port in sockets)
+		deadline = time.time() + timeout
+		while by_fileno:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			readable, _, _ = select.select([sock for sock, port in by_fileno.values()], [], [], remaining)
+			for sock in readable:
+				port = by_fileno[sock.fileno()][1]
+				try:
+					data, (ip, _) = sock.recvfrom(4096)
+					if port == TAPO_DISCOVERY_PORT:
+						device = parse_tapo_response(ip, data)
+					else:
+						device = parse_legacy_response(ip, json.loads(legacy_decrypt(data)))
+				except Exception as e:
+					self._logger.debug("Ignoring discovery reply: %s", e)
+					continue
+				results.setdefault(device["ip"], device)
+
+	def _sweep(self, network, results):
+		"""
+		Asks every host of network for its legacy sysinfo. Returns the hosts that did not answer but have an
+		open http port, they may be Tapo devices.
+		"""
+		hosts = [str(host) for host in network.hosts() if str(host) not in results]
+		tapo_candidates = []
+		mutex = threading.Lock()
+
+		def worker():
+			while True:
+				with mutex:
+					if not hosts:
+						return
+					ip = hosts.pop()
+				device = self._query_legacy(ip)
+				if device is not None:
+					with mutex:
+						results.setdefault(ip, device)
+				elif self._port_open(ip, 80):
+					with mutex:
+						tapo_candidates.append(ip)
+
+		threads = [threading.Thread(target=worker) for _ in range(min(self.max_workers, len(hosts)))]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			t.join()
+		return tapo_candidates
+
+	def _probe_candidates(self, tapo_candidates, results):
+		"""Sends the Tapo probe directly to hosts that did not answer the broadcast."""
+		probe = self._safe_tapo_probe()
+		if tapo_candidates and probe is not None:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			try:
+				for ip in tapo_candidates:
+					sock.sendto(probe, (ip, TAPO_DISCOVERY_PORT))
+				self._collect([(sock, TAPO_DISCOVERY_PORT)], results, self.connect_timeout * 2)
+			finally:
+				sock.close()
+
+	def _port_open(self, ip, port):
+		try:
+			sock = socket.create_connection((ip, port), self.connect_timeout)
+			sock.close()
+			return True
+		except (socket.error, socket.timeout):
+			return False
+
+	def _query_legacy(self, ip):
+		try:
+			sock = socket.create_connection((ip, LEGACY_PORT), self.connect_timeout)
+		except (socket.error, socket.timeout):
+			return None
+		try:
+			sock.settimeout(self.timeout)
+			sock.sendall(legacy_encrypt(json.dumps({"system": {"get_sysinfo": {}}})))
+			data = sock.recv(4096)
+			length = struct.unpack(">I", data[0:4])[0]
+			while len(data) - 4 < length:
+				chunk = sock.recv(4096)
+				if not chunk:
+					break
+				data += chunk
+			return parse_legacy_response(ip, json.loads(legacy_decrypt(data[4:])))
+		except Exception as e:
+			self._logger.debug("%s accepted a connection on %s but did not answer get_sysinfo: %s", ip, LEGACY_PORT, e)
+			return None
+		finally:
+			sock.close()
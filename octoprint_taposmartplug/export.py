@@ -0,0 +1,60 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+EXPORT_ARGUMENTS = ["ip", "start", "end", "format", "aggregate"]
+
+
+def export_handler():
+	"""
+	Builds the tornado handler serving energy exports at /plugin/taposmartplug/export. Responses served
+	through flask are collected in full before they are written, this handler writes every chunk as
+	soon as it is generated and waits for it to be flushed, so memory use does not depend on the range.
+	tornado is only imported when OctoPrint asks for the plugin's routes.
+	"""
+	from concurrent.futures import ThreadPoolExecutor
+
+	import tornado.gen
+	import tornado.iostream
+	import tornado.web
+
+	class EnergyExportHandler(tornado.web.RequestHandler):
+
+		def initialize(self, export, access_validation=None):
+			self._export = export
+			self._access_validation = access_validation
+
+		@tornado.gen.coroutine
+		def get(self):
+			if self._access_validation is not None:
+				self._access_validation(self.request)
+			args = [self.get_query_argument(name, None) for name in EXPORT_ARGUMENTS]
+
+			# the sqlite connection of an export must stay on the thread that opened it, and reading must not
+			# block the IOLoop, so every step of the export runs on one thread of its own
+			executor = ThreadPoolExecutor(max_workers=1)
+			body = None
+			try:
+				status, body, mimetype, filename = yield executor.submit(self._export, *args)
+				self.set_status(status)
+				self.set_header("Content-Type", mimetype)
+				if filename is not None:
+					self.set_header("Content-Disposition", 'attachment; filename="%s"' % filename)
+				if status != 200:
+					self.finish(body)
+					return
+
+				while True:
+					chunk = yield executor.submit(next, body, None)
+					if chunk is None:
+						break
+					self.write(chunk)
+					yield self.flush()
+				self.finish()
+			except tornado.iostream.StreamClosedError:
+				pass
+			finally:
+				if body is not None and hasattr(body, "close"):
+					executor.submit(body.close)
+				executor.shutdown(wait=False)
+
+	return EnergyExportHandler
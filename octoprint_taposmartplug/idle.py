@@ -0,0 +1,181 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+IDLE = "idle"
+COOLING = "cooling"
+WAITING_FOR_TIMELAPSE = "waiting_for_timelapse"
+COUNTDOWN = "countdown"
+SHUTDOWN = "shutdown"
+
+
+class IdleStateMachine(threading.Thread):
+	"""
+	Drives automatic power off: idle -> cooling -> waiting_for_timelapse -> countdown -> shutdown.
+
+	While idle, idle_deadline is pushed forward by activity(); once it passes and may_power_off() agrees,
+	the heaters are switched off and the machine waits for them to cool and for a running timelapse to
+	finish. The countdown is a single absolute deadline, clients render the remaining time themselves.
+	Activity in any state before shutdown returns the machine to idle. All waiting happens on this one
+	thread, callers only ever set deadlines and notify.
+	"""
+
+	POLL_INTERVAL = 5
+
+	def __init__(self, logger, idle_timeout, countdown, may_power_off, start_cooling, heaters_cooled,
+				 timelapse_active, shutdown, on_transition=None, history_size=20):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self._logger = logger
+		self.idle_timeout = idle_timeout
+		self.countdown = countdown
+		self._may_power_off = may_power_off
+		self._start_cooling = start_cooling
+		self._heaters_cooled = heaters_cooled
+		self._timelapse_active = timelapse_active
+		self._shutdown = shutdown
+		self._on_transition = on_transition
+		self._history_size = history_size
+		self._condition = threading.Condition()
+		self._running = True
+		self.enabled = False
+		self.state = IDLE
+		self.idle_deadline = None
+		self.countdown_deadline = None
+		self.transitions = []
+
+	def snapshot(self):
+		with self._condition:
+			return dict(enabled=self.enabled, state=self.state, idle_deadline=self.idle_deadline,
+						deadline=self.countdown_deadline, now=time.time(), transitions=list(self.transitions))
+
+	def activity(self, reason, abort=True):
+		"""
+		Pushes the idle deadline forward. With abort, a power off that is already in progress is cancelled,
+		otherwise only a waiting idle timeout is extended.
+		"""
+		if not self.enabled:
+			return
+		deadline = time.time() + self.idle_timeout
+		if self.state == IDLE and self.idle_deadline is not None:
+			# hot path for the gcode hook, the worker picks up the later deadline when it wakes up
+			self.idle_deadline = deadline
+			return
+		with self._condition:
+			if self.state == IDLE or abort:
+				self.idle_deadline = deadline
+				self._transition(IDLE, reason)
+				self._condition.notify()
+
+	def disarm(self, reason):
+		"""Stops waiting for the idle timeout until the next activity, e.g. because the plugs are off."""
+		with self._condition:
+			if self.state == IDLE:
+				self.idle_deadline = None
+				self._transition(IDLE, reason)
+
+	def enable(self, reason):
+		with self._condition:
+			self.enabled = True
+			self.idle_deadline = time.time() + self.idle_timeout
+			self._transition(IDLE, reason)
+			self._condition.notify()
+
+	def disable(self, reason):
+		with self._condition:
+			self.enabled = False
+			self.idle_deadline = None
+			self._transition(IDLE, reason)
+			self._condition.notify()
+
+	def stop(self):
+		with self._condition:
+			self._running = False
+			self._condition.notify()
+
+	def _transition(self, state, reason):
+		"""Must be called with the condition held."""
+		old_state = self.state
+		self.state = state
+		self.countdown_deadline = time.time() + self.countdown if state == COUNTDOWN else None
+		if old_state == state:
+			return
+		self.transitions.append(dict(source=old_state, target=state, reason=reason, at=time.time()))
+		del self.transitions[:-self._history_size]
+		self._logger.debug("Idle shutdown %s -> %s (%s).", old_state, state, reason)
+		if callable(self._on_transition):
+			self._on_transition(old_state, state, reason)
+
+	def _advance(self, expected, state, reason):
+		"""Moves from expected to state unless activity changed the state in the meantime."""
+		with self._condition:
+			if self.state != expected or not self.enabled:
+				return False
+			self._transition(state, reason)
+			return True
+
+	def run(self):
+		while True:
+			with self._condition:
+				if not self._running:
+					return
+				state = self.state
+				now = time.time()
+				if not self.enabled or (state == IDLE and self.idle_deadline is None) or state == SHUTDOWN:
+					self._condition.wait()
+					continue
+				if state == IDLE and self.idle_deadline > now:
+					self._condition.wait(self.idle_deadline - now)
+					continue
+				if state == COUNTDOWN and self.countdown_deadline > now:
+					self._condition.wait(self.countdown_deadline - now)
+					continue
+
+			try:
+				self._step(state)
+			except Exception:
+				self._logger.exception("Idle shutdown step in state %s failed.", state)
+				with self._condition:
+					self.idle_deadline = time.time() + self.idle_timeout
+					self._transition(IDLE, "error")
+
+	def _step(self, state):
+		if state == IDLE:
+			with self._condition:
+				if self.idle_deadline is None or self.idle_deadline > time.time():
+					return
+			if not self._may_power_off():
+				with self._condition:
+					self.idle_deadline = time.time() + self.idle_timeout
+				return
+			with self._condition:
+				# activity during may_power_off() only moved the deadline, look at it again before committing
+				if self.state != IDLE or not self.enabled or self.idle_deadline is None \
+						or self.idle_deadline > time.time():
+					return
+				self._transition(COOLING, "idle timeout")
+			# the heater off commands this queues are not activity, activity from now on aborts the cooling
+			self._start_cooling()
+		elif state == COOLING:
+			if self._heaters_cooled():
+				self._advance(COOLING, WAITING_FOR_TIMELAPSE, "heaters cooled")
+			else:
+				self._sleep()
+		elif state == WAITING_FOR_TIMELAPSE:
+			if not self._timelapse_active():
+				self._advance(WAITING_FOR_TIMELAPSE, COUNTDOWN, "timelapse finished")
+			else:
+				self._sleep()
+		elif state == COUNTDOWN:
+			if self._advance(COUNTDOWN, SHUTDOWN, "countdown elapsed"):
+				self._shutdown()
+				with self._condition:
+					if self.state == SHUTDOWN:
+						self.idle_deadline = None
+						self._transition(IDLE, "shutdown complete")
+
+	def _sleep(self):
+		with self._condition:
+			self._condition.wait(self.POLL_INTERVAL)
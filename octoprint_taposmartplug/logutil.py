@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+
+class PlugSummary(object):
+	"""
+	Wraps a plug dict (or a list of them) for logging. Only whitelisted keys are rendered, so credentials
+	never reach the log, and nothing is rendered unless the record is actually emitted.
+	"""
+
+	def __init__(self, plug, keys=None):
+		self.plug = plug
+		self.keys = keys or ["label", "ip"]
+
+	def _summarize(self, plug):
+		if not isinstance(plug, dict):
+			return repr(plug)
+		return "{%s}" % ", ".join("%s=%s" % (key, plug.get(key)) for key in self.keys if key in plug)
+
+	def __str__(self):
+		if isinstance(self.plug, (list, tuple)):
+			return "[%s]" % ", ".join(self._summarize(plug) for plug in self.plug)
+		return self._summarize(self.plug)
+
+
+class RepeatedMessageFilter(logging.Filter):
+	"""
+	Drops records identical to one logged less than interval seconds ago. The next record that gets
+	through for that message mentions how many repeats were dropped.
+	"""
+
+	def __init__(self, interval=30, max_entries=512):
+		logging.Filter.__init__(self)
+		self.interval = interval
+		self.max_entries = max_entries
+		self._seen = {}
+		self._mutex = threading.Lock()
+
+	def filter(self, record):
+		if record.levelno >= logging.WARNING:
+			return True
+
+		key = (record.levelno, record.getMessage())
+		now = time.time()
+		with self._mutex:
+			last_logged, suppressed = self._seen.get(key, (0, 0))
+			if now - last_logged < self.interval:
+				self._seen[key] = (last_logged, suppressed + 1)
+				return False
+			if len(self._seen) >= self.max_entries:
+				self._seen = dict((k, v) for k, v in self._seen.items() if now - v[0] < self.interval)
+			self._seen[key] = (now, 0)
+
+		if suppressed:
+			record.msg = "%s (repeated %s more times)" % (record.msg, suppressed)
+		return True
+
+
+def start_queued_logging(logger, handler):
+	"""
+	Attaches handler to logger through a QueueHandler, so records are written by a listener thread instead of
+	the thread that logs them. Returns the started listener, or None if handler was attached directly because
+	this Python has no QueueHandler.
+	"""
+	try:
+		from logging.handlers import QueueHandler, QueueListener
+		from queue import Queue
+	except ImportError:
+		logger.addHandler(handler)
+		return None
+
+	queue = Queue(-1)
+	listener = QueueListener(queue, handler, respect_handler_level=True)
+	logger.addHandler(QueueHandler(queue))
+	listener.start()
+	return listener
@@ -0,0 +1,110 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler(object):
+	"""
+	Wall clock sampling profiler for the plugin's code. While running, one thread snapshots the stacks
+	of all threads every interval seconds and counts those that pass through a file of this package, so
+	timers, the poller and the broker client are covered as well as the hooks OctoPrint calls on its comm
+	thread. When the window ends or stop() is called the counts are written in collapsed stack format
+	(thread;frame;frame count, as read by flamegraph.pl and speedscope) into folder.
+
+	Nothing is installed while it is not running, so a stopped profiler costs nothing.
+	"""
+
+	def __init__(self, logger, folder, root=None):
+		self._logger = logger
+		self.folder = folder
+		self.root = root or os.path.dirname(os.path.abspath(__file__))
+		self._mutex = threading.Lock()
+		self._thread = None
+		self._stop = None
+		self._state = dict(running=False, started=None, deadline=None, interval=None, samples=0, path=None)
+
+	def status(self):
+		with self._mutex:
+			return dict(self._state)
+
+	def start(self, duration, interval=0.01):
+		"""Starts a window of duration seconds. Returns the status, a running window is left alone."""
+		with self._mutex:
+			if self._state["running"]:
+				return dict(self._state)
+			now = time.time()
+			self._stop = threading.Event()
+			self._state = dict(running=True, started=now, deadline=now + duration, interval=interval, samples=0,
+							   path=None)
+			self._thread = threading.Thread(target=self._run, args=[self._stop, duration, interval])
+			self._thread.daemon = True
+			self._thread.start()
+			return dict(self._state)
+
+	def stop(self, timeout=10):
+		"""Ends the window early and waits for the profile to be written. Returns the status."""
+		with self._mutex:
+			thread, stop = self._thread, self._stop
+		if thread is not None:
+			stop.set()
+			thread.join(timeout)
+		return self.status()
+
+	def _in_plugin(self, frame):
+		while frame is not None:
+			if frame.f_code.co_filename.startswith(self.root):
+				return True
+			frame = frame.f_back
+		return False
+
+	@staticmethod
+	def _collapse(frame):
+		names = []
+		while frame is not None:
+			code = frame.f_code
+			names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+			frame = frame.f_back
+		return ";".join(reversed(names))
+
+	def _run(self, stop, duration, interval):
+		counts = {}
+		samples = 0
+		own = threading.current_thread().ident
+		deadline = time.time() + duration
+		try:
+			while not stop.is_set() and time.time() < deadline:
+				names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+				for ident, frame in sys._current_frames().items():
+					if ident == own or not self._in_plugin(frame):
+						continue
+					stack = "%s;%s" % (str(names.get(ident, ident)).replace(" ", "_"), self._collapse(frame))
+					counts[stack] = counts.get(stack, 0) + 1
+				samples += 1
+				frame = None
+				stop.wait(interval)
+		except Exception:
+			self._logger.exception("Profiler sampling failed.")
+
+		path = None
+		try:
+			path = self._write(counts)
+			self._logger.info("Wrote %s profiler samples to %s.", samples, path)
+		except Exception:
+			self._logger.exception("Could not write profile to %s.", self.folder)
+		finally:
+			with self._mutex:
+				self._state.update(running=False, samples=samples, path=path)
+				self._thread = None
+
+	def _write(self, counts):
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		path = os.path.join(self.folder, "profile-%s.collapsed" % time.strftime("%Y%m%d-%H%M%S"))
+		with open(path, "w") as f:
+			for stack, count in sorted(counts.items()):
+				f.write("%s %d\n" % (stack, count))
+		return path
@@ -0,0 +1,98 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from array import array
+
+
+class PowerRing(object):
+	"""
+	Fixed size buffer of the most recent (timestamp, power, total) samples of one plug. Samples live in
+	preallocated arrays, appending overwrites the oldest sample and reads hand out memoryview slices of
+	the arrays instead of copies. Timestamps are epoch milliseconds, power is in W and total in kWh.
+	"""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self._timestamps = array("q", [0] * capacity)
+		self._power = array("d", [0.0] * capacity)
+		self._total = array("d", [0.0] * capacity)
+		self._next = 0
+		self._count = 0
+
+	def __len__(self):
+		return self._count
+
+	def append(self, timestamp, power, total):
+		i = self._next
+		self._timestamps[i] = int(timestamp * 1000)
+		self._power[i] = power
+		self._total[i] = total
+		self._next = (i + 1) % self.capacity
+		if self._count < self.capacity:
+			self._count += 1
+
+	def _ranges(self, count):
+		"""Index ranges, oldest first, of the last count samples. Wrapped data takes two ranges."""
+		count = min(count, self._count)
+		start = (self._next - count) % self.capacity
+		if start + count <= self.capacity:
+			return [(start, start + count)]
+		return [(start, self.capacity), (0, self._next)]
+
+	def latest(self, count=None):
+		"""
+		The last count samples (all if count is None) as a list of (timestamps, power, total) memoryview
+		triples, oldest first. Only valid until the next append, callers copy what they keep.
+		"""
+		views = (memoryview(self._timestamps), memoryview(self._power), memoryview(self._total))
+		return [tuple(view[start:end] for view in views)
+				for start, end in self._ranges(self._count if count is None else count) if end > start]
+
+	def since(self, timestamp):
+		"""Like latest(), for the samples taken at or after timestamp (epoch seconds)."""
+		cutoff = int(timestamp * 1000)
+		count = 0
+		# samples are appended in time order, so walk back from the newest one
+		while count < self._count and self._timestamps[(self._next - count - 1) % self.capacity] >= cutoff:
+			count += 1
+		return self.latest(count)
+
+
+class PowerRings(object):
+	"""One PowerRing per plug ip, created on the first sample."""
+
+	def __init__(self, capacity=360):
+		self.capacity = max(1, capacity)
+		self._rings = {}
+		self._mutex = threading.Lock()
+
+	def append(self, plugip, power, total, timestamp=None):
+		with self._mutex:
+			ring = self._rings.get(plugip)
+			if ring is None:
+				ring = self._rings[plugip] = PowerRing(self.capacity)
+			ring.append(time.time() if timestamp is None else timestamp, power, total)
+
+	def snapshot(self, plugip, seconds=None):
+		"""Samples of plugip from the last seconds (all if None) as plain lists, ready to serialize."""
+		result = dict(ip=plugip, timestamps=[], power=[], total=[])
+		with self._mutex:
+			ring = self._rings.get(plugip)
+			if ring is None:
+				return result
+			chunks = ring.latest() if seconds is None else ring.since(time.time() - seconds)
+			for timestamps, power, total in chunks:
+				result["timestamps"].extend(timestamps.tolist())
+				result["power"].extend(power.tolist())
+				result["total"].extend(total.tolist())
+		return result
+
+	def resize(self, capacity):
+		"""Drops all buffered samples if capacity changed. A ring holds at least one sample."""
+		capacity = max(1, capacity)
+		with self._mutex:
+			if capacity != self.capacity:
+				self.capacity = capacity
+				self._rings = {}
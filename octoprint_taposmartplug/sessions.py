@@ -0,0 +1,222 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+
+ENERGY_MONITORING_MODELS = ["P110", "P115"]
+
+_child_ids = {}
+_child_ids_mutex = threading.Lock()
+
+
+def plug_host(plugip):
+	"""Strips the /N outlet suffix, all outlets of a strip share the parent's session."""
+	return plugip.split("/")[0].strip()
+
+
+def outlet_index(plugip):
+	"""The N of an "ip/N" strip outlet entry, counted in position order from 0, or None for a plain plug."""
+	parts = plugip.split("/")
+	if len(parts) < 2 or parts[1].strip() == "":
+		return None
+	return int(parts[1])
+
+
+def login(plug):
+	from PyP100 import PyP100
+
+	p100 = PyP100.P100(plug_host(plug["ip"]), plug["username"], plug["password"]) #Creating a P100 plug object
+	p100.handshake() #Creates the cookies required for further methods
+	p100.login() #Sends credentials to the plug and creates AES Key and IV for further methods
+	return p100
+
+
+def tapo_request(p100, method, params=None):
+	"""
+	Sends a request PyP100 has no method for over an already logged in session, the same way
+	PyP100 sends its own requests. Brokered sessions forward the request to the broker.
+	"""
+	if getattr(p100, "brokered", False):
+		return p100.request(method, params)
+
+	import requests
+
+	payload = {"method": method,
+			   "requestTimeMils": int(round(time.time() * 1000)),
+			   "terminalUUID": p100.terminalUUID}
+	if params is not None:
+		payload["params"] = params
+	secure_passthrough = {"method": "securePassthrough",
+						  "params": {"request": p100.tpLinkCipher.encrypt(json.dumps(payload))}}
+	r = requests.post("http://%s/app?token=%s" % (p100.ipAddress, p100.token), json=secure_passthrough,
+					  headers={"Cookie": p100.cookie}, timeout=5)
+	response = json.loads(p100.tpLinkCipher.decrypt(r.json()["result"]["response"]))
+	if response.get("error_code", 0) != 0:
+		raise Exception("%s failed with error code %s" % (method, response.get("error_code")))
+	return response
+
+
+def has_energy_monitoring(device_info):
+	model = (device_info or {}).get("result", {}).get("model") or ""
+	return any(model.startswith(energy_model) for energy_model in ENERGY_MONITORING_MODELS)
+
+
+def get_child_device_list(p100):
+	"""
+	State of every outlet of a strip in position order. The strip answers for all outlets at once, pages
+	are only followed for strips with more outlets than fit into one response.
+	"""
+	children = []
+	while True:
+		result = tapo_request(p100, "get_child_device_list", dict(start_index=len(children))).get("result", {})
+		page = result.get("child_device_list", [])
+		children.extend(page)
+		if not page or len(children) >= result.get("sum", len(children)):
+			break
+	children.sort(key=lambda child: child.get("position", 0))
+	with _child_ids_mutex:
+		_child_ids[p100.ipAddress] = [child.get("device_id") for child in children]
+	return children
+
+
+def outlet_info(children, plugip):
+	"""The entry of children plugip refers to, shaped like a getDeviceInfo response."""
+	index = outlet_index(plugip)
+	if index is None or index >= len(children):
+		raise Exception("%s has no outlet %s" % (plug_host(plugip), index))
+	return dict(error_code=0, result=children[index])
+
+
+def control_child(p100, device_id, method, params=None):
+	"""Runs method on one outlet of a strip through the strip's own session."""
+	request = {"method": method}
+	if params is not None:
+		request["params"] = params
+	response = tapo_request(p100, "control_child", {"device_id": device_id,
+													"requestData": {"method": "multipleRequest",
+																	"params": {"requests": [request]}}})
+	responses = response.get("result", {}).get("responseData", {}).get("result", {}).get("responses", [])
+	for child_response in responses:
+		if child_response.get("error_code", 0) != 0:
+			raise Exception("%s on %s failed with error code %s" % (method, device_id, child_response.get("error_code")))
+	return response
+
+
+def set_device_on(p100, plugip, on):
+	"""Switches a plug, or a single outlet if plugip is an "ip/N" strip entry."""
+	index = outlet_index(plugip)
+	if index is None or getattr(p100, "brokered", False):
+		return p100.turnOn() if on else p100.turnOff()
+	with _child_ids_mutex:
+		device_ids = _child_ids.get(p100.ipAddress)
+	if device_ids is None or index >= len(device_ids):
+		device_ids = [child.get("device_id") for child in get_child_device_list(p100)]
+	if index >= len(device_ids):
+		raise Exception("%s has no outlet %s" % (plug_host(plugip), index))
+	return control_child(p100, device_ids[index], "set_device_info", dict(device_on=on))
+
+
+def get_device_info(p100, logger=None, plugip=None):
+	"""
+	getDeviceInfo, plus the realtime energy usage under "energy_usage" for plugs that meter it. For an
+	"ip/N" strip entry the outlet's entry of the child device list is returned instead.
+	"""
+	if getattr(p100, "brokered", False):
+		return p100.getDeviceInfo()
+	if plugip is not None and outlet_index(plugip) is not None:
+		return outlet_info(get_child_device_list(p100), plugip)
+
+	response = p100.getDeviceInfo()
+	if has_energy_monitoring(response):
+		try:
+			response["energy_usage"] = tapo_request(p100, "get_energy_usage")
+		except Exception as e:
+			if logger is not None:
+				logger.debug("Could not read energy usage of %s: %s", p100.ipAddress, e)
+	return response
+
+
+class SessionPool(object):
+	"""
+	Keeps logged in PyP100 sessions per host and account for ttl seconds, so a command only costs the
+	encrypted request itself. warm() logs in ahead of time from a background thread. There is at most
+	one login per host and account in flight, get() waits for a running one instead of starting another.
+	"""
+
+	def __init__(self, logger, ttl=300, factory=login):
+		self._logger = logger
+		self.ttl = ttl
+		self._factory = factory
+		self._sessions = {}
+		self._logins = {}
+		self._mutex = threading.Lock()
+
+	@staticmethod
+	def _key(plug):
+		return plug_host(plug["ip"]), plug["username"]
+
+	def is_fresh(self, plug):
+		with self._mutex:
+			session = self._sessions.get(self._key(plug))
+			return session is not None and session[1] > time.time()
+
+	def _login(self, key, plug, pending):
+		"""Logs in as the owner of the pending login for key and wakes up everybody waiting for it."""
+		try:
+			p100 = self._factory(plug)
+			with self._mutex:
+				self._sessions[key] = (p100, time.time() + self.ttl)
+			return p100
+		finally:
+			with self._mutex:
+				del self._logins[key]
+			pending.set()
+
+	def get(self, plug):
+		"""Returns (session, cached). A new session is logged in if there is no fresh one."""
+		key = self._key(plug)
+		joined = False
+		while True:
+			with self._mutex:
+				session = self._sessions.get(key)
+				if session is not None and session[1] > time.time():
+					return session[0], not joined
+				pending = self._logins.get(key)
+				if pending is None:
+					pending = self._logins[key] = threading.Event()
+					break
+			# somebody else is logging in already, use their session. If that login failed, try ourselves.
+			pending.wait()
+			joined = True
+
+		return self._login(key, plug, pending), False
+
+	def invalidate(self, plug):
+		with self._mutex:
+			self._sessions.pop(self._key(plug), None)
+
+	def clear(self):
+		with self._mutex:
+			self._sessions = {}
+
+	def warm(self, plug):
+		"""Logs in to plug in the background unless a fresh session exists or a login is already running."""
+		key = self._key(plug)
+		with self._mutex:
+			session = self._sessions.get(key)
+			if key in self._logins or (session is not None and session[1] - self.ttl / 2.0 > time.time()):
+				return
+			pending = self._logins[key] = threading.Event()
+
+		def run():
+			try:
+				self._login(key, plug, pending)
+				self._logger.debug("Pre-warmed session for %s.", key[0])
+			except Exception as e:
+				self._logger.debug("Could not pre-warm session for %s: %s", key[0], e)
+
+		t = threading.Thread(target=run)
+		t.daemon = True
+		t.start()
@@ -56,6 +56,9 @@ $(function() {
 		self.dictSmartplugs = ko.observableDictionary();
 		self.refreshVisible = ko.observable(true);
 		self.powerOffWhenIdle = ko.observable(false);
+		self.discovering = ko.observable(false);
+		self.discoveredPlugs = ko.observableArray([]);
+		self.discoverCidr = ko.observable('');
 		self.filteredSmartplugs = ko.computed(function(){
 			return ko.utils.arrayFilter(self.dictSmartplugs.items(), function(item) {
 						return "err_code" in item.value().emeter.get_realtime;
@@ -134,9 +137,34 @@ $(function() {
 			}
 		}
 
+		self.updateTimeoutPopup = function() {
+			var remaining = 0;
+			if (typeof self.timeoutDeadline != "undefined") {
+				remaining = Math.round(self.timeoutDeadline - Date.now() / 1000);
+			}
+			if (remaining > 0) {
+				self.timeoutPopupOptions.text = self.timeoutPopupText + remaining;
+				if (typeof self.timeoutPopup != "undefined") {
+					self.timeoutPopup.update(self.timeoutPopupOptions);
+				} else {
+					self.timeoutPopup = new PNotify(self.timeoutPopupOptions);
+					self.timeoutPopup.get().on('pnotify.cancel', function() {self.abortShutdown(true);});
+				}
+				return;
+			}
+			if (typeof self.timeoutInterval != "undefined") {
+				clearInterval(self.timeoutInterval);
+				self.timeoutInterval = undefined;
+			}
+			if (typeof self.timeoutPopup != "undefined") {
+				self.timeoutPopup.remove();
+				self.timeoutPopup = undefined;
+			}
+		}
+
 		self.abortShutdown = function(abortShutdownValue) {
-			self.timeoutPopup.remove();
-			self.timeoutPopup = undefined;
+			self.timeoutDeadline = undefined;
+			self.updateTimeoutPopup();
 			$.ajax({
 				url: API_BASEURL + "plugin/taposmartplug",
 				type: "POST",
@@ -175,18 +203,13 @@ $(function() {
 			}
 		}
 
-		self.get_cost = function(data){ // make computedObservable()?
-			if("total" in data.emeter.get_realtime && typeof data.emeter.get_realtime.total == "function"){
-				return (data.emeter.get_realtime.total() * self.settings.settings.plugins.taposmartplug.cost_rate()).toFixed(2);
-			} else if ("total_wh" in data.emeter.get_realtime && typeof data.emeter.get_realtime.total_wh == "function") {
-				return ((data.emeter.get_realtime.total_wh()/1000) * self.settings.settings.plugins.taposmartplug.cost_rate()).toFixed(2);
-			} else if("total" in data.emeter.get_realtime && typeof data.emeter.get_realtime.total !== "function"){
-				return (data.emeter.get_realtime.total * self.settings.settings.plugins.taposmartplug.cost_rate()).toFixed(2);
-			} else if ("total_wh" in data.emeter.get_realtime && typeof data.emeter.get_realtime.total_wh !== "function") {
-				return ((data.emeter.get_realtime.total_wh/1000) * self.settings.settings.plugins.taposmartplug.cost_rate()).toFixed(2);
-			} else {
-				return "-"
+		self.get_cost = function(data){
+			// calculated on the server with the configured tariff, like the graph and the export
+			var cost = data.emeter.get_realtime.cost;
+			if (typeof cost == "function") {
+				cost = cost();
 			}
+			return (typeof cost == "number") ? cost.toFixed(2) : "-";
 		}
 
 		self.onStartup = function() {
@@ -281,6 +304,36 @@ $(function() {
 			$("#TapoPlugEditor").modal("show");
 		}
 
+		self.discoverPlugs = function() {
+			var credentials = ko.toJS(self.settings.settings.plugins.taposmartplug.arrSmartplugs)[0] || {};
+			self.discovering(true);
+			self.discoveredPlugs([]);
+			$.ajax({
+				url: API_BASEURL + "plugin/taposmartplug",
+				type: "POST",
+				dataType: "json",
+				data: JSON.stringify({
+					command: "discoverPlugs",
+					cidr: self.discoverCidr(),
+					username: credentials.username,
+					password: credentials.password,
+					async: true
+				}),
+				contentType: "application/json; charset=UTF-8"
+			}).fail(function(jqXHR) {
+				self.discovering(false);
+				if (jqXHR.status == 400) {
+					new PNotify({title: "Tapo Smartplug", text: jqXHR.responseText, type: "error", hide: true});
+				}
+			});
+		}
+
+		self.addDiscoveredPlug = function(ip, label) {
+			self.addPlug();
+			self.selectedPlug().ip(ip);
+			self.selectedPlug().label(label || ip);
+		}
+
 		self.removePlug = function(row) {
 			self.settings.settings.plugins.taposmartplug.arrSmartplugs.remove(row);
 		}
@@ -294,6 +347,21 @@ $(function() {
 				self.updateDictionary(data);
 			}
 
+			if(data.type == "job" && data.job.command == "discoverPlugs"){
+				self.discovering(false);
+				if(data.job.result && data.job.result.devices){
+					self.discoveredPlugs(data.job.result.devices);
+				}
+				return;
+			}
+
+			if(data.type == "job" && data.job.status != "queued" && data.job.status != "running"){
+				if(data.job.result){
+					self.updateDictionary(data.job.result);
+				}
+				self.processing.remove(data.job.ip);
+			}
+
 			if(data.check_status){
 				self.checkStatus(data.ip);
 			}
@@ -306,19 +374,16 @@ $(function() {
 				self.settings.settings.plugins.taposmartplug.powerOffWhenIdle(data.powerOffWhenIdle);
 
 				if (data.type == "timeout") {
-					if ((data.timeout_value != null) && (data.timeout_value > 0)) {
-						self.timeoutPopupOptions.text = self.timeoutPopupText + data.timeout_value;
-						if (typeof self.timeoutPopup != "undefined") {
-							self.timeoutPopup.update(self.timeoutPopupOptions);
-						} else {
-							self.timeoutPopup = new PNotify(self.timeoutPopupOptions);
-							self.timeoutPopup.get().on('pnotify.cancel', function() {self.abortShutdown(true);});
+					if (data.deadline != null) {
+						// the server only sends the deadline, shift it onto the local clock and count down here
+						self.timeoutDeadline = data.deadline + (Date.now() / 1000 - data.now);
+						self.updateTimeoutPopup();
+						if (typeof self.timeoutInterval == "undefined") {
+							self.timeoutInterval = setInterval(self.updateTimeoutPopup, 1000);
 						}
 					} else {
-						if (typeof self.timeoutPopup != "undefined") {
-							self.timeoutPopup.remove();
-							self.timeoutPopup = undefined;
-						}
+						self.timeoutDeadline = undefined;
+						self.updateTimeoutPopup();
 					}
 				}
 			}
@@ -349,13 +414,11 @@ $(function() {
 				dataType: "json",
 				data: JSON.stringify({
 					command: "turnOn",
-					ip: data.ip()
+					ip: data.ip(),
+					async: true
 				}),
 				contentType: "application/json; charset=UTF-8"
-			}).done(function(data){
-					self.updateDictionary(data);
-					self.processing.remove(data.ip);
-				});
+			});
 		};
 
 		self.turnOff = function(data) {
@@ -375,13 +438,11 @@ $(function() {
 			dataType: "json",
 			data: JSON.stringify({
 				command: "turnOff",
-				ip: data.ip()
+				ip: data.ip(),
+				async: true
 			}),
 			contentType: "application/json; charset=UTF-8"
-			}).done(function(data){
-					self.updateDictionary(data);
-					self.processing.remove(data.ip);
-				});
+			});
 		}
 
 		self.plotEnergyData = function(data) {
@@ -396,105 +457,150 @@ $(function() {
 					record_limit: self.plotted_graph_records(),
 					record_offset: self.plotted_graph_records_offset()
 				}),
-				cost_rate: self.settings.settings.plugins.taposmartplug.cost_rate(),
 				contentType: "application/json; charset=UTF-8"
 				}).done(function(data){
-						var trace_current = {x:[],y:[],mode:'lines+markers',name:'Current (Amp)',xaxis: 'x2',yaxis: 'y2'};
-						var trace_power = {x:[],y:[],mode:'lines+markers',name:'Power (W)',xaxis: 'x3',yaxis: 'y3'}; 
-						var trace_total = {x:[],y:[],mode:'lines+markers',name:'Total (kWh)'};
-						var trace_cost = {x:[],y:[],mode:'lines+markers',name:'Cost'}
-
-						ko.utils.arrayForEach(data.energy_data, function(row){
-							trace_current.x.push(row[0]);
-							trace_current.y.push(row[1]);
-							trace_power.x.push(row[0]);
-							trace_power.y.push(row[2]);
-							trace_total.x.push(row[0]);
-							trace_total.y.push(row[3]);
-							trace_cost.x.push(row[0]);
-							trace_cost.y.push(row[3]*self.settings.settings.plugins.taposmartplug.cost_rate());
-						});
-						var layout = {title:'Tapo Smartplug Energy Data',
-									grid: {rows: 2, columns: 1, pattern: 'independent'},
-									autosize: true,
-									showlegend: false,
-									xaxis: {
-										showticklabels: false,
-										anchor: 'x'
-									},
-									yaxis: {
-										title: 'Total (kWh)',
-										hoverformat: '.3f kWh',
-										tickangle: 45,
-										tickfont: {
-											size: 10
-										},
-										tickformat: '.2f',
-										anchor: 'y'
-									},
-									xaxis2: {
-										anchor: 'y2'
-									},
-									yaxis2: {
-										title: 'Current (Amp)',
-										hoverformat: '.3f',
-										anchor: 'x2',
-										tickangle: 45,
-										tickfont: {
-											size: 10
-										},
-										tickformat: '.2f'
-									},
-									xaxis3: {
-										overlaying: 'x2',
-										anchor: 'y3',
-										showticklabels: false
-									},
-									yaxis3: {
-										overlaying: 'y2',
-										side: 'right',
-										title: 'Power (W)',
-										hoverformat: '.3f',
-										anchor: 'x3',
-										tickangle: -45,
-										tickfont: {
-											size: 10
-										},
-										tickformat: '.2f'
-									},
-									xaxis4: {
-										overlaying: 'x',
-										anchor: 'y4',
-										showticklabels: false
-									},
-									yaxis4: {
-										overlaying: 'y',
-										side: 'right',
-										title: 'Cost',
-										hoverformat: '.3f',
-										anchor: 'x4',
-										tickangle: -45,
-										tickfont: {
-											size: 10
-										},
-										tickformat: '.2f'
-									}};
-						var options = {
-									showLink: false,
-									sendData: false,
-									displaylogo: false,
-									editable: false,
-									showTips: false
-								};
-
-						var plot_data = [trace_total,trace_current,trace_power,trace_cost/* ,trace_voltage */]
-						if(window.location.href.indexOf('taposmartplug') > 0){
-							Plotly.react('taposmartplug_energy_graph',plot_data,layout,options);
-						}
+						self.energyHistory = {ip: self.plotted_graph_ip(), rows: data.energy_data, live: []};
+						self.renderEnergyGraph();
 					});
 			}
 		}
 
+		self.energyHistory = null;
+
+		self.formatLocalTimestamp = function(ms) {
+			var d = new Date(ms);
+			var pad = function(n) {return (n < 10 ? "0" : "") + n;};
+			return d.getFullYear() + "-" + pad(d.getMonth() + 1) + "-" + pad(d.getDate()) + " " +
+				pad(d.getHours()) + ":" + pad(d.getMinutes()) + ":" + pad(d.getSeconds());
+		}
+
+		self.refreshLiveEnergy = function() {
+			// new samples come from the server's in memory buffer, the stored history is only loaded again
+			// when the plug, record count or offset changes
+			var history = self.energyHistory;
+			if (!history || history.ip != self.plotted_graph_ip() || self.plotted_graph_records_offset() != 0) {
+				self.plotEnergyData();
+				return;
+			}
+			var last = history.rows.length ? new Date(history.rows[history.rows.length - 1][0].replace(" ", "T")).getTime() : 0;
+			$.ajax({
+				url: API_BASEURL + "plugin/taposmartplug",
+				type: "GET",
+				dataType: "json",
+				data: {live: history.ip, seconds: last ? Math.max(1, Math.ceil((Date.now() - last) / 1000)) : ""},
+				contentType: "application/json; charset=UTF-8"
+			}).done(function(data){
+				if (self.energyHistory !== history) {
+					return;
+				}
+				history.live = [];
+				for (var i = 0; i < data.timestamps.length; i++) {
+					if (data.timestamps[i] > last) {
+						history.live.push([self.formatLocalTimestamp(data.timestamps[i]), null, data.power[i], data.total[i], null]);
+					}
+				}
+				self.renderEnergyGraph();
+			});
+		}
+
+		self.renderEnergyGraph = function() {
+			var history = self.energyHistory;
+			var trace_current = {x:[],y:[],mode:'lines+markers',name:'Current (Amp)',xaxis: 'x2',yaxis: 'y2'};
+			var trace_power = {x:[],y:[],mode:'lines+markers',name:'Power (W)',xaxis: 'x3',yaxis: 'y3'}; 
+			var trace_total = {x:[],y:[],mode:'lines+markers',name:'Total (kWh)'};
+			var trace_cost = {x:[],y:[],mode:'lines+markers',name:'Cost'}
+
+			ko.utils.arrayForEach(history.rows.concat(history.live), function(row){
+				trace_current.x.push(row[0]);
+				trace_current.y.push(row[1]);
+				trace_power.x.push(row[0]);
+				trace_power.y.push(row[2]);
+				trace_total.x.push(row[0]);
+				trace_total.y.push(row[3]);
+				if (row[4] !== null) {
+					trace_cost.x.push(row[0]);
+					trace_cost.y.push(row[4]);
+				}
+			});
+			var layout = {title:'Tapo Smartplug Energy Data',
+						grid: {rows: 2, columns: 1, pattern: 'independent'},
+						autosize: true,
+						showlegend: false,
+						xaxis: {
+							showticklabels: false,
+							anchor: 'x'
+						},
+						yaxis: {
+							title: 'Total (kWh)',
+							hoverformat: '.3f kWh',
+							tickangle: 45,
+							tickfont: {
+								size: 10
+							},
+							tickformat: '.2f',
+							anchor: 'y'
+						},
+						xaxis2: {
+							anchor: 'y2'
+						},
+						yaxis2: {
+							title: 'Current (Amp)',
+							hoverformat: '.3f',
+							anchor: 'x2',
+							tickangle: 45,
+							tickfont: {
+								size: 10
+							},
+							tickformat: '.2f'
+						},
+						xaxis3: {
+							overlaying: 'x2',
+							anchor: 'y3',
+							showticklabels: false
+						},
+						yaxis3: {
+							overlaying: 'y2',
+							side: 'right',
+							title: 'Power (W)',
+							hoverformat: '.3f',
+							anchor: 'x3',
+							tickangle: -45,
+							tickfont: {
+								size: 10
+							},
+							tickformat: '.2f'
+						},
+						xaxis4: {
+							overlaying: 'x',
+							anchor: 'y4',
+							showticklabels: false
+						},
+						yaxis4: {
+							overlaying: 'y',
+							side: 'right',
+							title: 'Cost',
+							hoverformat: '.3f',
+							anchor: 'x4',
+							tickangle: -45,
+							tickfont: {
+								size: 10
+							},
+							tickformat: '.2f'
+						}};
+			var options = {
+						showLink: false,
+						sendData: false,
+						displaylogo: false,
+						editable: false,
+						showTips: false
+					};
+
+			var plot_data = [trace_total,trace_current,trace_power,trace_cost/* ,trace_voltage */]
+			if(window.location.href.indexOf('taposmartplug') > 0){
+				Plotly.react('taposmartplug_energy_graph',plot_data,layout,options);
+			}
+		}
+
 		self.legend_visible = ko.observable(false);
 
 		self.toggle_legend = function(){
@@ -512,7 +618,7 @@ $(function() {
 								item.emeter.get_realtime[key] = ko.observable(data.emeter.get_realtime[key]);
 							}
 							if(data.ip == self.plotted_graph_ip() && window.location.href.indexOf('taposmartplug') > 0){
-								self.plotEnergyData();
+								self.refreshLiveEnergy();
 							}
 						}
 						self.processing.remove(data.ip);
@@ -532,14 +638,47 @@ $(function() {
 			}).done(self.updateDictionary);
 		}; 
 
+		self.statusesETag = undefined;
+		self.statusesKnown = {};
+
 		self.checkStatuses = function() {
-			ko.utils.arrayForEach(self.arrSmartplugs(),function(item){
-				if(item.ip() !== "") {
-					self.processing.push(item.ip());
-					self.checkStatus(item.ip());
+			// one request for all cached states, nothing is transferred if they did not change since the last one
+			var headers = {};
+			if (typeof self.statusesETag != "undefined") {
+				headers["If-None-Match"] = self.statusesETag;
+			}
+			$.ajax({
+				url: API_BASEURL + "plugin/taposmartplug",
+				type: "GET",
+				dataType: "json",
+				data: {statuses: 1},
+				headers: headers,
+				contentType: "application/json; charset=UTF-8"
+			}).done(function(data, textStatus, jqXHR){
+				if (jqXHR.status != 304 && data) {
+					self.statusesETag = jqXHR.getResponseHeader("ETag") || undefined;
+					self.statusesKnown = {};
+					ko.utils.arrayForEach(data.plugs, function(status){
+						if (status.last_seen) {
+							self.statusesKnown[status.ip] = true;
+							self.updateDictionary(status);
+						}
+					});
 				}
+				// plugs the server has not talked to yet, e.g. ones just added, are asked for individually,
+				// also when nothing changed on the server since the last response
+				ko.utils.arrayForEach(self.arrSmartplugs(),function(item){
+					if(item.ip() !== "" && !self.statusesKnown[item.ip()]) {
+						self.processing.push(item.ip());
+						self.checkStatus(item.ip());
+					}
+				});
 			});
 		};
+
+		self.onDataUpdaterReconnect = function() {
+			self.checkStatuses();
+		};
 	}
 
 	OCTOPRINT_VIEWMODELS.push([
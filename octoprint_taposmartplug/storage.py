@@ -0,0 +1,231 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+from .tariff import TIMESTAMP_FORMAT, normalize_timestamp
+
+SAMPLE_COLUMNS = "datetime(ts, 'unixepoch', 'localtime'), current_ma / 1000.0, power_mw / 1000.0, total_wh / 1000.0, voltage_mv / 1000.0"
+
+
+def to_epoch(timestamp):
+	"""Stored format local time string to epoch seconds."""
+	return int(time.mktime(time.strptime(timestamp, TIMESTAMP_FORMAT)))
+
+
+def to_fixed(value):
+	"""A, W, kWh and V are stored as integer mA, mW, Wh and mV."""
+	return None if value is None else int(round(value * 1000))
+
+
+class EnergyStore(object):
+	"""
+	Owns energy_data.db. sqlite3 is only imported once the store is actually used and the schema is
+	created from a background thread, so neither slows down plugin import or on_startup.
+
+	Samples live in energy_samples, clustered on (plug_id, ts) without a rowid, with the plug ip
+	in a plugs dictionary, epoch second timestamps and fixed point integer readings. Rows of the old
+	energy_data table (ip and timestamp TEXT, REAL readings) are moved over in chunks after startup.
+	The public methods keep taking and returning local "%Y-%m-%d %H:%M:%S" timestamps and floats.
+	"""
+
+	MIGRATION_CHUNK = 5000
+
+	def __init__(self, db_path, logger):
+		self.db_path = db_path
+		self._logger = logger
+		self._ready = threading.Event()
+		# set once no rows of the old energy_data table are left, until then history may be incomplete
+		self.migrated = threading.Event()
+		self._plug_ids = {}
+		self._plug_ids_mutex = threading.Lock()
+
+	def initialize_async(self):
+		t = threading.Thread(target=self.initialize)
+		t.daemon = True
+		t.start()
+		return t
+
+	def initialize(self):
+		migrate = False
+		try:
+			db = self.connect(wait=False)
+			try:
+				cursor = db.cursor()
+				cursor.execute('''CREATE TABLE IF NOT EXISTS plugs(id INTEGER PRIMARY KEY, ip TEXT NOT NULL UNIQUE)''')
+				cursor.execute(
+					'''CREATE TABLE IF NOT EXISTS energy_samples(plug_id INTEGER NOT NULL, ts INTEGER NOT NULL, current_ma INTEGER, power_mw INTEGER, total_wh INTEGER, voltage_mv INTEGER, PRIMARY KEY (plug_id, ts)) WITHOUT ROWID''')
+				db.commit()
+				migrate = self._has_table(cursor, "energy_data")
+			finally:
+				db.close()
+		except Exception:
+			self._logger.exception("Could not initialize energy database %s.", self.db_path)
+		finally:
+			self._ready.set()
+
+		if migrate:
+			self._migrate_energy_data()
+		else:
+			self.migrated.set()
+
+	def _migrate_energy_data(self):
+		"""
+		Moves energy_data into energy_samples. Every chunk is copied and deleted in one transaction, so an
+		interrupted migration picks up where it stopped on the next start. New samples are written to the
+		new table meanwhile, older history shows up as it is converted.
+		"""
+		moved = 0
+		try:
+			db = self.connect()
+			try:
+				cursor = db.cursor()
+				while True:
+					cursor.execute(
+						"SELECT id, ip, timestamp, current, power, total, voltage FROM energy_data ORDER BY id LIMIT ?",
+						[self.MIGRATION_CHUNK])
+					rows = cursor.fetchall()
+					if not rows:
+						break
+					samples = []
+					for row_id, ip, timestamp, current, power, total, voltage in rows:
+						try:
+							ts = to_epoch(normalize_timestamp(timestamp))
+						except (ValueError, TypeError, OverflowError):
+							continue
+						samples.append([self._plug_id(cursor, ip, create=True), ts, to_fixed(current), to_fixed(power),
+										to_fixed(total), to_fixed(voltage)])
+					cursor.executemany(
+						"INSERT OR IGNORE INTO energy_samples(plug_id, ts, current_ma, power_mw, total_wh, voltage_mv) VALUES (?, ?, ?, ?, ?, ?)",
+						samples)
+					cursor.execute("DELETE FROM energy_data WHERE id <= ?", [rows[-1][0]])
+					db.commit()
+					moved += len(rows)
+
+				cursor.execute("DROP TABLE energy_data")
+				db.commit()
+				self.migrated.set()
+				self._logger.info("Converted %s energy samples to the compact schema.", moved)
+				# hand the space of the old table back to the file system, a locked database just keeps it
+				try:
+					db.execute("VACUUM")
+				except Exception as e:
+					self._logger.info("Could not compact %s after the conversion: %s", self.db_path, e)
+			finally:
+				db.close()
+		except Exception:
+			self._logger.exception("Converting energy_data in %s failed after %s rows.", self.db_path, moved)
+
+	@staticmethod
+	def _has_table(cursor, name):
+		cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", [name])
+		return cursor.fetchone() is not None
+
+	def _plug_id(self, cursor, ip, create=False):
+		with self._plug_ids_mutex:
+			plug_id = self._plug_ids.get(ip)
+		if plug_id is not None:
+			return plug_id
+		if create:
+			cursor.execute("INSERT OR IGNORE INTO plugs(ip) VALUES (?)", [ip])
+		cursor.execute("SELECT id FROM plugs WHERE ip = ?", [ip])
+		row = cursor.fetchone()
+		if row is None:
+			return None
+		with self._plug_ids_mutex:
+			self._plug_ids[ip] = row[0]
+		return row[0]
+
+	def wait_ready(self, timeout=None):
+		return self._ready.wait(timeout)
+
+	def connect(self, wait=True):
+		import sqlite3
+
+		if wait:
+			self._ready.wait()
+		return sqlite3.connect(self.db_path)
+
+	def iter_samples(self, ip, start=None, end=None, batch_size=500):
+		"""
+		Yields (timestamp, current, power, total, voltage) rows for ip ordered by time. Rows are fetched in
+		batches from a server side cursor so memory use does not depend on the size of the range.
+		"""
+		db = self.connect()
+		try:
+			cursor = db.cursor()
+			plug_id = self._plug_id(cursor, ip)
+			if plug_id is None:
+				return
+
+			where = ["plug_id = ?"]
+			params = [plug_id]
+			if start:
+				where.append("ts >= ?")
+				params.append(to_epoch(start))
+			if end:
+				where.append("ts < ?")
+				params.append(to_epoch(end))
+
+			cursor.execute("SELECT %s FROM energy_samples WHERE %s ORDER BY ts" % (SAMPLE_COLUMNS, " AND ".join(where)),
+						   params)
+			while True:
+				rows = cursor.fetchmany(batch_size)
+				if not rows:
+					break
+				for row in rows:
+					yield row
+		finally:
+			db.close()
+
+	def last_total_before(self, ip, timestamp):
+		db = self.connect()
+		try:
+			cursor = db.cursor()
+			plug_id = self._plug_id(cursor, ip)
+			if plug_id is None:
+				return None
+			cursor.execute(
+				"SELECT total_wh / 1000.0 FROM energy_samples WHERE plug_id = ? AND ts < ? AND total_wh IS NOT NULL ORDER BY ts DESC LIMIT 1",
+				[plug_id, to_epoch(timestamp)])
+			row = cursor.fetchone()
+			return row[0] if row else None
+		finally:
+			db.close()
+
+	def latest_samples(self, ip, limit, offset=0):
+		"""Returns the newest limit rows for ip, skipping offset rows, oldest first."""
+		db = self.connect()
+		try:
+			cursor = db.cursor()
+			plug_id = self._plug_id(cursor, ip)
+			if plug_id is None:
+				return []
+			cursor.execute(
+				"SELECT %s FROM energy_samples WHERE plug_id = ? ORDER BY ts DESC LIMIT ? OFFSET ?" % SAMPLE_COLUMNS,
+				[plug_id, int(limit), int(offset)])
+			return list(reversed(cursor.fetchall()))
+		finally:
+			db.close()
+
+	def insert_samples(self, ip, samples):
+		"""
+		Stores (timestamp, current, power, total, voltage) samples for ip. timestamp is epoch seconds, or a
+		local time string which is ambiguous in the hour repeated when daylight saving time ends. Samples for
+		a timestamp that is already stored are ignored. Returns the number of rows added.
+		"""
+		db = self.connect()
+		try:
+			cursor = db.cursor()
+			plug_id = self._plug_id(cursor, ip, create=True)
+			before = db.total_changes
+			cursor.executemany(
+				"INSERT OR IGNORE INTO energy_samples(plug_id, ts, current_ma, power_mw, total_wh, voltage_mv) VALUES (?, ?, ?, ?, ?, ?)",
+				[[plug_id, timestamp if isinstance(timestamp, int) else to_epoch(timestamp), to_fixed(current),
+				  to_fixed(power), to_fixed(total), to_fixed(voltage)]
+				 for timestamp, current, power, total, voltage in samples])
+			db.commit()
+			return db.total_changes - before
+		finally:
+			db.close()
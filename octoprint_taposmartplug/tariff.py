@@ -0,0 +1,196 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import datetime
+import threading
+
+MINUTES_PER_DAY = 24 * 60
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_weekend_days = {}
+
+
+def _parse_minute(value):
+	hours, minutes = str(value).split(":")
+	return (int(hours) * 60 + int(minutes)) % MINUTES_PER_DAY
+
+
+class Tariff(object):
+	"""
+	Time of use tariff. Bands are dicts like
+
+		dict(start="07:00", end="23:00", rate=0.30, days="weekday")
+
+	where days is one of "all", "weekday" or "weekend". Bands may wrap around midnight and the first
+	matching band wins, anything not covered by a band is billed at default_rate. The bands are
+	expanded into one rate per minute for weekdays and weekends up front, so pricing a sample is a
+	table lookup.
+	"""
+
+	def __init__(self, default_rate, bands=None):
+		self.default_rate = float(default_rate or 0)
+		self.bands = list(bands or [])
+		self._rates = dict(weekday=[self.default_rate] * MINUTES_PER_DAY,
+						   weekend=[self.default_rate] * MINUTES_PER_DAY)
+
+		for day_type, rates in self._rates.items():
+			assigned = [False] * MINUTES_PER_DAY
+			for band in self.bands:
+				if band.get("days", "all") not in ["all", day_type]:
+					continue
+				start = _parse_minute(band.get("start", "00:00"))
+				end = _parse_minute(band.get("end", "00:00"))
+				length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+				for offset in range(length):
+					minute = (start + offset) % MINUTES_PER_DAY
+					if not assigned[minute]:
+						rates[minute] = float(band["rate"])
+						assigned[minute] = True
+
+	@property
+	def key(self):
+		return (self.default_rate, tuple(tuple(sorted(band.items())) for band in self.bands))
+
+	@property
+	def is_free(self):
+		return self.default_rate == 0 and all(float(band.get("rate", 0)) == 0 for band in self.bands)
+
+	def rate_at(self, timestamp):
+		"""timestamp is a local time string as stored, a date without a time is priced at midnight."""
+		day = timestamp[:10]
+		weekend = _weekend_days.get(day)
+		if weekend is None:
+			weekend = datetime.date(int(day[0:4]), int(day[5:7]), int(day[8:10])).weekday() >= 5
+			if len(_weekend_days) > 1024:
+				_weekend_days.clear()
+			_weekend_days[day] = weekend
+		minute = int(timestamp[11:13]) * 60 + int(timestamp[14:16]) if len(timestamp) >= 16 else 0
+		return self._rates["weekend" if weekend else "weekday"][minute]
+
+	def iter_costs(self, rows, baseline_total=None, baseline_timestamp=None):
+		"""
+		Takes (timestamp, current, power, total, voltage) rows ordered by time and yields
+		(row, energy, cost) where energy is the kWh consumed since the previous row, priced at the rate
+		in effect at the start of that interval: the previous row, or baseline_timestamp for the first
+		one. total is the device's month to date counter. A drop in total counts as a reset when it
+		crosses into a new month or loses more than half of the total, smaller drops (a backfilled
+		total disagreeing with a live one by a few Wh) count as no consumption.
+		"""
+		previous = baseline_total
+		previous_timestamp = baseline_timestamp
+		for row in rows:
+			total = row[3]
+			if total is None:
+				yield row, 0.0, 0.0
+				continue
+			if previous is None:
+				energy = 0.0
+			elif total >= previous:
+				energy = total - previous
+			elif (previous_timestamp is not None and previous_timestamp[:7] != row[0][:7]) or total < previous / 2.0:
+				energy = total
+			else:
+				# keep the higher total, so the overlap is not counted again once the counter passes it
+				energy = 0.0
+				total = previous
+			previous = total
+			start = previous_timestamp or row[0]
+			previous_timestamp = row[0]
+			yield row, energy, energy * self.rate_at(start) if energy else 0.0
+
+	def cost(self, rows, baseline_total=None, baseline_timestamp=None):
+		energy = cost = 0.0
+		for row, row_energy, row_cost in self.iter_costs(rows, baseline_total, baseline_timestamp):
+			energy += row_energy
+			cost += row_cost
+		return energy, cost
+
+
+BUCKETS = dict(hour=lambda timestamp: timestamp[:13] + ":00:00",
+			   day=lambda timestamp: timestamp[:10] + " 00:00:00")
+
+
+def aggregate_costs(costed_rows, period):
+	"""
+	Groups the (row, energy, cost) results of iter_costs per hour or day, averaging current, power and
+	voltage, keeping the last total and summing energy and cost. Every sample is priced before it is
+	grouped, so a bucket spanning several tariff bands is billed correctly.
+	"""
+	bucket_of = BUCKETS[period]
+	bucket = None
+	for row, energy, cost in costed_rows:
+		key = bucket_of(row[0])
+		if bucket is not None and key != bucket[0]:
+			yield _bucket_row(bucket)
+			bucket = None
+		if bucket is None:
+			# key, sums and counts of current, power and voltage, total, energy, cost
+			bucket = [key, [0.0, 0.0, 0.0], [0, 0, 0], None, 0.0, 0.0]
+		for index, value in enumerate([row[1], row[2], row[4]]):
+			if value is not None:
+				bucket[1][index] += value
+				bucket[2][index] += 1
+		if row[3] is not None:
+			bucket[3] = row[3]
+		bucket[4] += energy
+		bucket[5] += cost
+	if bucket is not None:
+		yield _bucket_row(bucket)
+
+
+def _bucket_row(bucket):
+	key, sums, counts, total, energy, cost = bucket
+	averages = [value / count if count else None for value, count in zip(sums, counts)]
+	return (key, averages[0], averages[1], total, averages[2]), energy, cost
+
+
+def normalize_timestamp(value):
+	"""Accepts "YYYY-MM-DD", "YYYY-MM-DD HH:MM" or "YYYY-MM-DDTHH:MM:SS" and returns the stored format."""
+	value = str(value).strip().replace("T", " ")
+	for fmt in [TIMESTAMP_FORMAT, "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+		try:
+			return datetime.datetime.strptime(value[:19], fmt).strftime(TIMESTAMP_FORMAT)
+		except ValueError:
+			continue
+	raise ValueError("Invalid timestamp %s" % value)
+
+
+def day_segments(start, end):
+	"""Splits [start, end) into (start, end) pairs that do not cross midnight."""
+	current = datetime.datetime.strptime(start, TIMESTAMP_FORMAT)
+	end = datetime.datetime.strptime(end, TIMESTAMP_FORMAT)
+	while current < end:
+		next_day = datetime.datetime.combine(current.date() + datetime.timedelta(days=1), datetime.time())
+		segment_end = min(next_day, end)
+		yield current.strftime(TIMESTAMP_FORMAT), segment_end.strftime(TIMESTAMP_FORMAT)
+		current = segment_end
+
+
+class CostCache(object):
+	"""
+	Remembers (energy, cost) results for intervals that are already closed. Samples for the past are
+	not expected to change, so anything ending before now is cached until the tariff changes.
+	"""
+
+	def __init__(self, max_entries=2048):
+		self.max_entries = max_entries
+		self._entries = {}
+		self._mutex = threading.Lock()
+
+	def get(self, key):
+		with self._mutex:
+			return self._entries.get(key)
+
+	def put(self, key, value):
+		with self._mutex:
+			if len(self._entries) >= self.max_entries:
+				self._entries.pop(next(iter(self._entries)))
+			self._entries[key] = value
+
+	def invalidate(self, ip=None):
+		with self._mutex:
+			if ip is None:
+				self._entries.clear()
+			else:
+				for key in [k for k in self._entries if k[0] == ip]:
+					del self._entries[key]
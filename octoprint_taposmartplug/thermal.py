@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+from collections import deque
+
+
+class HeaterWindow(object):
+	"""
+	Statistics over the last window seconds of one heater, updated in amortized constant time per sample.
+
+	excess is how far the heater is above what it was asked for: the temperature itself while the target
+	is 0, otherwise the overshoot above the target. rise is the increase of excess from its minimum in
+	the window, so a heater ramping up to its target does not count, one that keeps heating past it does.
+	mean_deviation is the average of actual - target. The window starts over whenever the target changes.
+	"""
+
+	def __init__(self, window):
+		self.window = window
+		self.target = None
+		self._samples = deque()
+		self._minimums = deque()
+		self._deviation_sum = 0.0
+
+	def _reset(self, target):
+		self.target = target
+		self._samples.clear()
+		self._minimums.clear()
+		self._deviation_sum = 0.0
+
+	def add(self, timestamp, actual, target):
+		target = target or 0
+		if target != self.target:
+			self._reset(target)
+
+		excess = actual if target == 0 else max(0.0, actual - target)
+		deviation = actual - target
+		self._samples.append((timestamp, excess, deviation))
+		self._deviation_sum += deviation
+		# the front of _minimums is always the smallest excess still in the window
+		while self._minimums and self._minimums[-1][1] >= excess:
+			self._minimums.pop()
+		self._minimums.append((timestamp, excess))
+
+		cutoff = timestamp - self.window
+		while self._samples[0][0] < cutoff:
+			self._deviation_sum -= self._samples.popleft()[2]
+		while self._minimums[0][0] < cutoff:
+			self._minimums.popleft()
+
+	@property
+	def span(self):
+		return self._samples[-1][0] - self._samples[0][0] if self._samples else 0
+
+	@property
+	def rise(self):
+		return self._samples[-1][1] - self._minimums[0][1] if self._samples else 0
+
+	@property
+	def rate(self):
+		"""Change of the temperature over the window in degrees per minute."""
+		span = self.span
+		if span <= 0:
+			return 0
+		return (self._samples[-1][2] - self._samples[0][2]) / span * 60
+
+	@property
+	def mean_deviation(self):
+		return self._deviation_sum / len(self._samples) if self._samples else 0
+
+
+class ThermalMonitor(object):
+	"""
+	Checks every temperature report against the trip rules, a rule set to 0 is off:
+
+	- max_bed / max_extruder: absolute maximum temperature.
+	- max_rise: the heater got more than max_rise degrees hotter than asked for within the window.
+	- max_deviation: the heater was on average more than max_deviation degrees above its target over
+	  at least half the window.
+
+	update() only does arithmetic on the windows, it is meant to be called from the comm thread.
+	"""
+
+	def __init__(self, max_bed=0, max_extruder=0, window=30, max_rise=0, max_deviation=0, prewarm_margin=10):
+		self.max_bed = max_bed
+		self.max_extruder = max_extruder
+		self.window = window
+		self.max_rise = max_rise
+		self.max_deviation = max_deviation
+		self.prewarm_margin = prewarm_margin
+		self.near_limit = False
+		self._windows = {}
+
+	def _limit(self, heater):
+		if heater == "B":
+			return self.max_bed
+		if heater.startswith("T"):
+			return self.max_extruder
+		return 0
+
+	def update(self, parsed_temps, now=None):
+		"""Adds a report and returns a list of (heater, reason) for every rule it trips."""
+		now = time.time() if now is None else now
+		trips = []
+		near_limit = False
+		for heater, (actual, target) in parsed_temps.items():
+			if actual is None:
+				continue
+			limit = self._limit(heater)
+			if limit > 0:
+				if actual > limit:
+					trips.append((heater, "%.1f above maximum of %s" % (actual, limit)))
+				elif actual > limit - self.prewarm_margin:
+					near_limit = True
+			if self.max_rise <= 0 and self.max_deviation <= 0:
+				continue
+
+			window = self._windows.get(heater)
+			if window is None:
+				window = self._windows[heater] = HeaterWindow(self.window)
+			window.add(now, actual, target)
+			if self.max_rise > 0:
+				if window.rise > self.max_rise:
+					trips.append((heater, "rose %.1f past its target of %s within %ss" % (window.rise, window.target, self.window)))
+				elif window.rise > self.max_rise / 2.0:
+					near_limit = True
+			if self.max_deviation > 0 and window.target > 0 and window.span >= self.window / 2.0 \
+					and window.mean_deviation > self.max_deviation:
+				trips.append((heater, "averaged %.1f above its target of %s" % (window.mean_deviation, window.target)))
+		self.near_limit = near_limit
+		return trips
+
+	def stats(self):
+		return dict((heater, dict(target=window.target, rise=window.rise, rate=window.rate,
+								  mean_deviation=window.mean_deviation, span=window.span))
+					for heater, window in self._windows.items())